@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths of salt_func_lib on synthetic data.
+
+Usage:
+    python salt_benchmarks.py --out bench.json
+    python salt_benchmarks.py --out bench.json --baseline bench_baseline.json --tolerance 0.2
+
+Results are written to json (median and min seconds per call of every
+benchmark). With --baseline, benchmarks whose median is more than tolerance
+slower than in the baseline are reported as regressions and the exit code
+is 1. Everything runs offline on generated data.
+
+Before the timings a few correctness checks are run (skip them with
+--no-checks); a failing check also gives exit code 1.
+
+The time to import salt_func_lib in a fresh interpreter is measured too; the
+part spent outside of torch must stay under --import-target seconds.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import imageio
+import numpy as np
+import pandas as pd
+import torch
+from torchvision import transforms
+
+import salt_func_lib as sfl
+
+
+def synthetic_data(n=64, size=101, seed=0):
+    """Random images and blob masks shaped like the competition data."""
+    rng = np.random.default_rng(seed)
+    images = rng.integers(0, 256, (n, size, size, 1), dtype=np.uint8)
+    yy, xx = np.mgrid[:size, :size]
+    cy, cx, r = rng.uniform(0, size, n), rng.uniform(0, size, n), rng.uniform(0, size/2, n)
+    masks = ((yy - cy[:, None, None])**2 + (xx - cx[:, None, None])**2 < r[:, None, None]**2)
+    masks[:n//4] = False
+    df_depth = pd.DataFrame({'z': rng.integers(50, 950, n)}, index=[f'id{k:05d}' for k in range(n)])
+
+    return images, masks.astype(np.uint8)[..., None], df_depth
+
+
+def timeit(fn, repeat=5, number=1, warmup=1):
+    """Median and min seconds per call of fn."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+
+    return {'median': statistics.median(times), 'min': min(times), 'repeat': repeat, 'number': number}
+
+
+def loss_step(criterion, y_pred, y):
+    def step():
+        p = y_pred.clone().requires_grad_()
+        criterion(p, y).backward()
+    return step
+
+
+def net_step(net, X, backward):
+    def step():
+        net.train(backward)
+        if backward:
+            net.zero_grad()
+            net(X).mean().backward()
+        else:
+            with torch.no_grad():
+                net(X)
+    return step
+
+
+def get_benchmarks(quick=False, tmp_dir=None):
+    """Map of benchmark name to a function to time."""
+    n = 32 if quick else 128
+    images, masks, df_depth = synthetic_data(n)
+    mean_img = images.mean(0)
+    masks_3d = masks[..., 0]
+    y_prob = torch.from_numpy(np.random.default_rng(1).random((n, 101, 101), dtype=np.float32))
+    y_true = torch.from_numpy(masks_3d).float()
+    benchmarks = {}
+
+    benchmarks['rle_encoder2d'] = lambda: [sfl.rle_encoder2d(m) for m in masks_3d[:8]]
+    benchmarks['rle_encoder3d'] = lambda: sfl.rle_encoder3d(masks_3d)
+    benchmarks['calc_raw_iou'] = lambda: sfl.calc_raw_iou(y_prob.ge(0.5), y_true)
+    benchmarks['calc_mean_iou'] = lambda: sfl.calc_mean_iou(y_prob.ge(0.5), y_true)
+
+    batch = slice(0, 32)
+    for name, criterion in [('IOU_Loss', sfl.IOU_Loss()), ('Dice_Loss', sfl.Dice_Loss()),
+                            ('FocalLoss', sfl.FocalLoss()), ('LovaszHingeLoss', sfl.LovaszHingeLoss()),
+                            ('HingeLoss', sfl.HingeLoss()),
+                            ('CombinedLoss', sfl.CombinedLoss(iou=1, dice=1, focal=1, lovasz=1, hinge=1))]:
+        benchmarks[f'loss_{name}'] = loss_step(criterion, y_prob[batch], y_true[batch])
+
+    composed = transforms.Compose([sfl.Rescale(scale='random', max_scale=3),
+                                   sfl.RandomCrop(101),
+                                   sfl.Flip(orient='random')])
+    for name, tsfm, cache in [('no_transform', None, False), ('transform', composed, False),
+                              ('cached', None, True)]:
+        ds = sfl.SaltDataset(images, masks, df_depth, mean_img, out_size=128, transform=tsfm, cache=cache)
+        benchmarks[f'SaltDataset_getitem_{name}'] = (lambda ds=ds: [ds[k] for k in range(16)])
+    benchmarks['SaltDataset_getitems_cached'] = lambda: ds.__getitems__(list(range(16)))
+
+    if tmp_dir is not None:
+        png_dir = os.path.join(tmp_dir, 'png')
+        os.makedirs(png_dir, exist_ok=True)
+        for k in range(n):
+            imageio.imwrite(os.path.join(png_dir, f'{k:05d}.png'), images[k, :, :, 0])
+        benchmarks['load_img_to_np'] = lambda: sfl.load_img_to_np(png_dir, n_jobs=1, verbose=False)
+
+    net = sfl.SaltNet()
+    for batch_size in ([8] if quick else [8, 32, 64]):
+        X = torch.randn(batch_size, 1, 128, 128)
+        benchmarks[f'SaltNet_forward_bs{batch_size}'] = net_step(net, X, backward=False)
+        benchmarks[f'SaltNet_forward_backward_bs{batch_size}'] = net_step(net, X, backward=True)
+
+    section = np.random.default_rng(2).integers(0, 256, (202 if quick else 404, 606), dtype=np.uint8)
+    for batch_size in [8, 64]:
+        benchmarks[f'predict_section_bs{batch_size}'] = (
+            lambda batch_size=batch_size: sfl.predict_section(net, section, mean_img, batch_size=batch_size,
+                                                              verbose=False))
+
+    members = [sfl.SaltNet().eval() for _ in range(3)]
+    ensemble = sfl.SaltNetEnsemble(members)
+    X = torch.randn(8, 1, 101, 101)
+    benchmarks['SaltNet_3_separate_forward_bs8'] = lambda: [net_step(m, X, backward=False)() for m in members]
+    benchmarks['SaltNetEnsemble_3_forward_bs8'] = net_step(ensemble, X, backward=False)
+
+    return benchmarks
+
+
+def check_rle_parity():
+    """rle_encoder3d matches rle_encoder2d on (N, H, W) and (N, H, W, 1) masks."""
+    _, masks, _ = synthetic_data(16)
+    expected = [sfl.rle_encoder2d(m) for m in masks]
+    assert list(sfl.rle_encoder3d(masks)) == expected, '4-D masks'
+    assert list(sfl.rle_encoder3d(masks[..., 0])) == expected, '3-D masks'
+
+
+def check_iou_accumulator():
+    """IouAccumulator over batches matches calc_mean_iou and calc_clf_accuracy of the whole set."""
+    rng = np.random.default_rng(6)
+    y_prob = torch.from_numpy(rng.random((40, 101, 101), dtype=np.float32))
+    _, masks, _ = synthetic_data(40, seed=6)
+    y_true = torch.from_numpy(masks[..., 0]).float()
+    y_soft = y_true * torch.from_numpy(rng.choice([0.5, 1.], (40, 101, 101)).astype(np.float32))
+    for name, a, b in [('bool', y_prob.ge(0.5), y_true.ge(0.5)), ('float', y_prob.ge(0.5).float(), y_soft)]:
+        acc = sfl.IouAccumulator()
+        for k in range(0, 40, 16):
+            acc.update(a[k:k + 16], b[k:k + 16])
+        assert abs(acc.mean_iou() - sfl.calc_mean_iou(a.float(), b.float())) < 1e-12, f'{name} mean IOU'
+        assert abs(acc.accuracy() - sfl.calc_clf_accuracy(a, b)) < 1e-12, f'{name} accuracy'
+
+
+def check_lovasz_batch():
+    """Batched Lovasz hinge matches the per-image lovasz_hinge_flat, loss and gradients, with and without ignore."""
+    rng = np.random.default_rng(7)
+    logits = torch.from_numpy(rng.normal(size=(6, 101, 101)).astype(np.float32))
+    _, masks, _ = synthetic_data(6, seed=7)
+    labels = torch.from_numpy(masks[..., 0]).long()
+    labels_ignore = torch.where(torch.from_numpy(rng.random((6, 101, 101)) < 0.1), torch.tensor(255), labels)
+    labels_ignore[1] = 255  # an image with only ignored pixels
+    criterion = sfl.LovaszHingeLoss()
+    for name, y, ignore in [('no ignore', labels, None), ('ignore', labels_ignore, 255)]:
+        p_batch = logits.clone().requires_grad_()
+        loss_batch = criterion(p_batch, y, ignore=ignore)
+        loss_batch.backward()
+        p_ref = logits.clone().requires_grad_()
+        loss_ref = torch.stack([criterion.lovasz_hinge_flat(*criterion.flatten_binary_scores(p_k, y_k, ignore))
+                                for p_k, y_k in zip(p_ref, y)]).mean()
+        loss_ref.backward()
+        assert abs(loss_batch.item() - loss_ref.item()) < 1e-5, f'{name} loss'
+        assert torch.allclose(p_batch.grad, p_ref.grad, atol=1e-7), f'{name} gradients'
+
+
+def _dense_raw_iou(a, b):
+    # calc_raw_iou before the popcount path
+    a, b = np.clip(np.asarray(a, dtype=np.float64), 0, 1), np.clip(np.asarray(b, dtype=np.float64), 0, 1)
+    u = np.sum(np.clip(a + b, 0, 1), (1, 2))
+    i = np.sum(np.where((a + b) == 2, 1, 0), (1, 2)).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(i == u, 1, np.where(u == 0, 0, i / u))
+
+
+def check_packed_iou():
+    """calc_raw_iou on packed binary masks matches the dense computation, empty masks included."""
+    rng = np.random.default_rng(14)
+    _, masks, _ = synthetic_data(48, seed=14)
+    y_true = masks[..., 0]
+    y_pred = (rng.random(y_true.shape) < 0.5).astype(np.uint8) | y_true
+    y_pred[:6] = 0  # empty predictions, a quarter of y_true is empty too
+    for name, a, b in [('uint8', y_pred, y_true),
+                       ('bool tensor', torch.from_numpy(y_pred).bool(), torch.from_numpy(y_true).bool()),
+                       ('float tensor', torch.from_numpy(y_pred).float(), torch.from_numpy(y_true).float()),
+                       ('PackedMasks', y_pred, sfl.PackedMasks.from_masks(y_true))]:
+        assert np.array_equal(sfl.calc_raw_iou(a, b), _dense_raw_iou(y_pred, y_true)), name
+    y_soft = y_pred * 0.5
+    assert np.allclose(sfl.calc_raw_iou(y_soft, y_true), _dense_raw_iou(y_soft, y_true), rtol=0, atol=1e-12), \
+        'non-binary'
+
+
+def check_search_threshold_cutoff():
+    """search_threshold_cutoff scores match looping adjust_predictions and calc_mean_iou over the grid."""
+    rng = np.random.default_rng(13)
+    images, masks, _ = synthetic_data(24, seed=13)
+    images[:3] = 0  # black images are predicted empty
+    y = masks[..., 0]
+    y_prob = np.clip(y * 0.6 + rng.random(y.shape, dtype=np.float32) * 0.5, 0, 1).astype(np.float32)
+    thresholds, cut_offs = [0.3, 0.5, 0.7], [0, 50, 400]
+    _, _, _, scores = sfl.search_threshold_cutoff(y_prob, y, X=images, thresholds=thresholds, cut_offs=cut_offs)
+    for t in thresholds:
+        for c in cut_offs:
+            y_adj = sfl.adjust_predictions(c, images, (y_prob >= t).astype(np.float32))
+            expected = sfl.calc_mean_iou(y_adj, y)
+            assert abs(scores.loc[t, c] - expected) < 1e-12, f'threshold {t}, cut off {c}'
+
+
+def check_ensemble():
+    """SaltNetEnsemble outputs match running its members separately."""
+    torch.manual_seed(24)
+    members = [sfl.SaltNet() for _ in range(3)]
+    for m in members:
+        # non-trivial BatchNorm statistics, as after training
+        for bn in m.modules():
+            if isinstance(bn, torch.nn.BatchNorm2d):
+                bn.running_mean.uniform_(-0.5, 0.5)
+                bn.running_var.uniform_(0.5, 2)
+        m.eval()
+    X = torch.randn(4, 1, 101, 101)
+    with torch.no_grad():
+        expected = torch.stack([m(X) for m in members], 1)
+        for combine, reference in [('none', expected), ('mean', expected.mean(1)),
+                                   ('vote', expected.gt(0.5).float().mean(1))]:
+            out = sfl.SaltNetEnsemble(members, combine=combine)(X)
+            assert out.shape == reference.shape, f'{combine} shape'
+            if combine == 'vote':
+                # a member output within float error of 0.5 may flip its vote
+                near = (expected - 0.5).abs().lt(1e-5).any(1)
+                assert torch.equal(out[~near], reference[~near]), combine
+            else:
+                assert torch.allclose(out, reference, rtol=0, atol=1e-5), combine
+
+
+def check_predict_section():
+    """predict_section matches blending every window predicted on its own over the full map."""
+    torch.manual_seed(25)
+    net = sfl.SaltNet().eval()
+    rng = np.random.default_rng(25)
+    section = rng.integers(0, 256, (180, 260), dtype=np.uint8)
+    mean_img = rng.uniform(0, 255, (101, 101, 1)).astype(np.float32)
+    for stride, window, batch_size in [(50, 'hann', 4), (37, 'triangle', 64), (101, 'uniform', 1)]:
+        weight = sfl.blend_window(101, window)
+        acc, wsum = np.zeros(section.shape), np.zeros(section.shape)
+        with torch.no_grad():
+            for y in sfl._window_starts(180, 101, stride):
+                for x in sfl._window_starts(260, 101, stride):
+                    X = sfl.preprocess_images(section[None, y:y + 101, x:x + 101, None], mean_img)
+                    acc[y:y + 101, x:x + 101] += net(X).numpy() * weight
+                    wsum[y:y + 101, x:x + 101] += weight
+        out = sfl.predict_section(net, section, mean_img, stride=stride, batch_size=batch_size, window=window,
+                                  verbose=False)
+        assert np.allclose(out, acc / wsum, rtol=0, atol=1e-5), f'stride {stride}, {window}, batch {batch_size}'
+
+
+class _Unpicklable(object):
+    def __reduce__(self):
+        raise RuntimeError('cannot be pickled')
+
+
+def check_failed_save_keeps_checkpoint():
+    """A save_model_state_to_chunks that raises leaves the previous checkpoint loadable."""
+    tmp_dir = tempfile.mkdtemp(prefix='salt_check_')
+    try:
+        model_state = {'w': torch.arange(10000, dtype=torch.float32)}
+        sfl.save_model_state_to_chunks(0, model_state, {}, {}, {}, 'ckpt', tmp_dir, chunk_size=4096)
+        try:
+            sfl.save_model_state_to_chunks(1, {'w': torch.zeros(20000)}, {}, {}, {'bad': _Unpicklable()},
+                                           'ckpt', tmp_dir, chunk_size=4096)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError('the save did not raise')
+        assert not glob.glob(os.path.join(tmp_dir, '*.part')), '.part files left behind'
+        state = sfl.load_model_state_from_chunks('ckpt', tmp_dir)
+        assert state['epoch'] == 1, 'epoch of the previous checkpoint'
+        assert torch.equal(state['model']['w'], model_state['w']), 'weights of the previous checkpoint'
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+CHECKS = [check_rle_parity, check_iou_accumulator, check_lovasz_batch, check_failed_save_keeps_checkpoint,
+          check_search_threshold_cutoff, check_packed_iou, check_ensemble, check_predict_section]
+
+
+def run_checks():
+    """Names of the failed checks, the errors are printed."""
+    failed = []
+    for check in CHECKS:
+        try:
+            check()
+            print(f'check {check.__name__}: ok')
+        except Exception as e:
+            print(f'check {check.__name__}: FAILED {type(e).__name__}: {e}')
+            failed.append(check.__name__)
+
+    return failed
+
+
+def measure_import_time(module='salt_func_lib', repeat=3):
+    """Median seconds to import module and torch alone, each in a fresh interpreter."""
+    code = ('import sys, time; sys.path.insert(0, {!r}); start = time.perf_counter(); '
+            'import {}; print(time.perf_counter() - start)')
+    lib_dir = os.path.dirname(os.path.abspath(__file__))
+    times = {module: [], 'torch': []}
+    # the first run only warms the file system cache, the two imports are interleaved after it
+    for k in range(repeat + 1):
+        for name in times:
+            out = subprocess.run([sys.executable, '-c', code.format(lib_dir, name)], check=True,
+                                 capture_output=True, text=True).stdout
+            if k > 0:
+                times[name].append(float(out))
+
+    return statistics.median(times[module]), statistics.median(times['torch'])
+
+
+def run_benchmarks(pattern=None, quick=False, repeat=5):
+    tmp_dir = tempfile.mkdtemp(prefix='salt_bench_')
+    try:
+        benchmarks = get_benchmarks(quick=quick, tmp_dir=tmp_dir)
+        results = {}
+        for name, fn in benchmarks.items():
+            if pattern is not None and not re.search(pattern, name):
+                continue
+            results[name] = timeit(fn, repeat=repeat)
+            print('{:<40} {:>10.2f} ms'.format(name, results[name]['median'] * 1000))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if pattern is None or re.search(pattern, 'import_salt_func_lib'):
+        total, torch_only = measure_import_time()
+        results['import_salt_func_lib'] = {'median': total, 'min': total, 'repeat': 3, 'number': 1,
+                                           'torch': torch_only, 'overhead': total - torch_only}
+        print('{:<40} {:>10.2f} ms ({:.2f} ms without torch)'.format(
+            'import_salt_func_lib', total * 1000, (total - torch_only) * 1000))
+
+    return {'meta': {'time': sfl.get_current_time_as_fname(), 'python': platform.python_version(),
+                     'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                     'torch': torch.__version__, 'numpy': np.__version__,
+                     'torch_threads': torch.get_num_threads(), 'quick': quick},
+            'results': results}
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """Benchmarks more than tolerance slower than the baseline, as a list of
+    (name, baseline seconds, current seconds)."""
+    regressions = []
+    for name, res in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        if res['median'] > base['median'] * (1 + tolerance):
+            regressions.append((name, base['median'], res['median']))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default='bench_results.json', help='json file for the results')
+    parser.add_argument('--baseline', default=None, help='json results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slow down, 0.2 is 20%%')
+    parser.add_argument('--filter', default=None, help='regex of the benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--import-target', type=float, default=0.5,
+                        help='max seconds importing salt_func_lib may take on top of importing torch')
+    parser.add_argument('--quick', action='store_true', help='smaller data and fewer batch sizes')
+    parser.add_argument('--no-checks', action='store_true', help='skip the correctness checks')
+    args = parser.parse_args(argv)
+
+    failed = [] if args.no_checks else run_checks()
+    results = run_benchmarks(pattern=args.filter, quick=args.quick, repeat=args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f'Results written to {args.out}')
+
+    status = 1 if failed else 0
+    import_time = results['results'].get('import_salt_func_lib')
+    if import_time is not None and import_time['overhead'] > args.import_target:
+        print('IMPORT TIME {:.2f} s over torch is above the target of {:.2f} s'.format(
+            import_time['overhead'], args.import_target))
+        status = 1
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for name, base, current in regressions:
+            print('REGRESSION {:<40} {:>10.2f} ms -> {:>10.2f} ms ({:+.0%})'.format(
+                name, base * 1000, current * 1000, current / base - 1))
+        if regressions:
+            return 1
+        print(f'No regressions against {args.baseline}')
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
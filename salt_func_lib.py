@@ -5,37 +5,62 @@ Created on Fri Aug 17 20:19:23 2018
 @author: Allen
 """
 
-import zipfile
+import importlib
 import torch
-import torchvision
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils import data
-from torch.utils.data import Dataset, DataLoader
-from torchvision import transforms, utils
-from skimage import io, transform
-from sklearn.model_selection import train_test_split
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as ply
 import os
 import sys
-import imageio
-from PIL import Image
 import glob
-import matplotlib.pyplot as plt
 import time
 import math
 import datetime as dt
-import pytz
 import pickle
+import json
+import hashlib
 import logging
-from io import BytesIO
+import warnings
+from io import BytesIO, BufferedReader, RawIOBase, SEEK_SET, SEEK_CUR, SEEK_END
+import bisect
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import copy
+import contextlib
 from itertools import  filterfalse
 
+# pandas, skimage, matplotlib, imageio and pytz are slow to import and only
+# needed by a few functions, so they are imported where they are used. This
+# keeps importing this module (and every spawned DataLoader worker) cheap.
+_LAZY_MODULES = {'pd': 'pandas', 'plt': 'matplotlib.pyplot', 'ply': 'matplotlib.pyplot',
+                 'io': 'skimage.io', 'transform': 'skimage.transform', 'imageio': 'imageio', 'pytz': 'pytz',
+                 'torchvision': 'torchvision', 'transforms': 'torchvision.transforms',
+                 'utils': 'torchvision.utils', 'zipfile': 'zipfile'}
+# names this module used to import from them, as (module, attribute)
+_LAZY_NAMES = {'train_test_split': ('sklearn.model_selection', 'train_test_split'),
+               'Image': ('PIL.Image', None), 'Figure': ('matplotlib.figure', 'Figure')}
+
+
+def __getattr__(name):
+    # module attributes such as salt_func_lib.pd still work, on first use
+    if name in _LAZY_MODULES:
+        return importlib.import_module(_LAZY_MODULES[name])
+    if name in _LAZY_NAMES:
+        module, attr = _LAZY_NAMES[name]
+        module = importlib.import_module(module)
+        return module if attr is None else getattr(module, attr)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 def get_logger(logger_name, level=logging.DEBUG):
     # logger
+    import pytz
     file_name = '{}{}'.format('./',
                                 logger_name)
     timestamp = dt.datetime.now(pytz.timezone('Australia/Melbourne'))\
@@ -66,7 +91,23 @@ def get_logger(logger_name, level=logging.DEBUG):
 
     return logging.getLogger(logger_name)
 
-log = get_logger('SaltNet')
+class _LazyLogger(object):
+    """The 'SaltNet' logger, set up with get_logger (and so its log file)
+    the first time it is used rather than on import."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        logger = logging.getLogger(self.name)
+        if not logger.handlers:
+            logger = get_logger(self.name)
+        return getattr(logger, attr)
+
+
+log = _LazyLogger('SaltNet')
 
 if torch.cuda.is_available():
     dtype = torch.cuda.FloatTensor ## UNCOMMENT THIS LINE IF YOU'RE ON A GPU!
@@ -105,6 +146,7 @@ class Rescale(object):
         self.max_scale = max_scale
 
     def __call__(self, sample):
+        from skimage import transform
         image, mask = sample['image'], sample['mask']
 
         if self.scale == 'random':
@@ -191,6 +233,91 @@ class Flip(object):
 
         return {'image':img_final, 'mask':mask_final}
 
+
+class BatchRescaleCropFlip(object):
+    """Rescale, RandomCrop and Flip applied to a whole batch of tensors.
+
+    Each sample gets its own random scale, crop offset and flip, and all three
+    are done by a single grid_sample call on the device of the batch.
+
+    Args:
+        scale: 'random' or a fixed scale factor, as in Rescale.
+        min_scale (float): Lower bound of the random scale.
+        max_scale (float): Upper bound of the random scale.
+        output_size (int): Crop size, as in RandomCrop. Defaults to the mask size.
+        orient (string): 'H', 'W' (or 'V'), 'NA' or 'random', as in Flip.
+    """
+
+    def __init__(self, scale='random', min_scale=1, max_scale=3, output_size=None, orient='random'):
+        assert orient in ['H', 'W', 'V', 'NA', 'random']
+        self.scale = scale
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.output_size = output_size
+        self.orient = orient
+
+    def __call__(self, images, masks=None):
+        """
+        Args:
+            images (Tensor): (B, C, H, W) images. If they are larger than the
+                masks they are treated as reflect padded (as done by
+                SaltDataset), so only the centre is transformed and the
+                output is padded again.
+            masks (Tensor, optional): (B, h, w) or (B, 1, h, w) masks.
+        Returns:
+            tuple: (images, masks) transformed, masks is None if not given.
+        """
+        b, c, h_pad, w_pad = images.shape
+        device = images.device
+        mask_dim = None if masks is None else masks.dim()
+        if masks is not None and mask_dim == 3:
+            masks = masks.unsqueeze(1)
+        h, w = (h_pad, w_pad) if masks is None else masks.shape[-2:]
+        pad_top, pad_left = (h_pad - h)//2, (w_pad - w)//2
+        x = images[:, :, pad_top:pad_top + h, pad_left:pad_left + w]
+        if masks is not None:
+            x = torch.cat([x, masks.to(x.dtype)], 1)
+
+        if self.scale == 'random':
+            scale = torch.empty(b, device=device).uniform_(self.min_scale, self.max_scale)
+        else:
+            scale = torch.full((b,), float(self.scale), device=device)
+        out_h = out_w = self.output_size or h
+        # size of the rescaled image as in Rescale, then the random crop offset
+        resized = torch.round(max(h, w) * scale)
+        top = torch.floor(torch.rand(b, device=device) * (resized - out_h).clamp(min=0))
+        left = torch.floor(torch.rand(b, device=device) * (resized - out_w).clamp(min=0))
+
+        if self.orient == 'random':
+            orient = torch.randint(0, 4, (b,), device=device)
+        else:
+            orient = torch.full((b,), {'H': 0, 'W': 1, 'V': 1, 'NA': 2}[self.orient], device=device)
+        flip_w = torch.where(orient == 0, -1.0, 1.0).to(device)
+        flip_h = torch.where(orient == 1, -1.0, 1.0).to(device)
+
+        # map normalised crop coordinates back to the un-scaled input
+        theta = torch.zeros(b, 2, 3, device=device)
+        theta[:, 0, 0] = out_w / resized * flip_w
+        theta[:, 0, 2] = (2 * left + out_w) / resized - 1
+        theta[:, 1, 1] = out_h / resized * flip_h
+        theta[:, 1, 2] = (2 * top + out_h) / resized - 1
+        grid = F.affine_grid(theta.to(x.dtype), (b, x.shape[1], out_h, out_w), align_corners=False)
+        x = F.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+        images_out = x[:, :c]
+        pad_h, pad_w = h_pad - out_h, w_pad - out_w
+        if pad_h > 0 or pad_w > 0:
+            images_out = F.pad(images_out, (pad_w//2, pad_w - pad_w//2, pad_h//2, pad_h - pad_h//2),
+                               mode='reflect')
+        masks_out = None
+        if masks is not None:
+            masks_out = x[:, c:]
+            if mask_dim == 3:
+                masks_out = masks_out.squeeze(1)
+
+        return images_out, masks_out
+
+
 '''composed = transforms.Compose([Rescale(scale='random', max_scale=5),
                                RandomCrop(101),
                                Flip(orient='random')])
@@ -203,26 +330,145 @@ x_final, m_final = transformed['image'], transformed['mask']'''
 class SaltDataset(Dataset):
     """Face Landmarks dataset."""
 
-    def __init__(self, np_img, np_mask, df_depth, mean_img, out_size=101, out_ch=1, transform=None):
+    def __init__(self, np_img, np_mask, df_depth, mean_img, out_size=101, out_ch=1, transform=None,
+                 cache=False, cache_dtype='float32'):
         """
         Args:
             data_dir (string): Path to the image files.
             train (bool): Load train or test data
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            cache (bool): Precompute the non-random preprocessing (mean
+                subtraction, padding, mask resize, depth lookup) once into
+                tensors in shared memory. Only possible when transform is
+                None, with a transform it is skipped with a warning.
+            cache_dtype (string): 'float32' to cache the padded images
+                ready to use, or 'uint8' to cache the padded pixels (4x
+                smaller) and subtract the mean image on access. uint8
+                images are cached as they are, other images as uint8 plus
+                a scale and offset, which rounds them to 256 levels.
+                Masks that are not binary are always cached as float32.
+
+        Binary 101x101 masks, or a PackedMasks, are kept bit-packed and only
+        unpacked when an item or batch is read.
         """
+        assert cache_dtype in ['float32', 'uint8']
         self.np_img = np_img
-        self.np_mask = np_mask.clip(0,1)
+        if np_mask is None or isinstance(np_mask, PackedMasks):
+            self.np_mask = np_mask
+        elif tuple(np_mask.shape[1:3]) == (101, 101) and _is_binary(np.asarray(np_mask)):
+            self.np_mask = PackedMasks.from_masks(np_mask)
+        else:
+            self.np_mask = np_mask.clip(0,1)
         self.df_depth = df_depth
         self.mean_img = mean_img
         self.out_size = out_size
         self.out_ch = out_ch
         self.transform = transform
+        self.cache_dtype = cache_dtype
+        self.cached = False
+        if cache:
+            self.build_cache()
+
+    def build_cache(self, chunk_size=1000):
+        """Run the deterministic part of __getitem__ for all items once.
+
+        The tensors are moved to shared memory so DataLoader workers read
+        them without copying. Nothing is cached if the dataset has a
+        transform, as every item is then computed from np_img.
+        """
+        if self.transform:
+            warnings.warn('SaltDataset cache is not built: it is not used with a transform')
+            return
+        n, h, w = len(self.np_img), self.np_img.shape[1], self.np_img.shape[2]
+        pad_size = self.out_size - h
+        pad_first = pad_size//2
+        pad_last = pad_size - pad_first
+        pad_width = [(0, 0), (0, 0), (pad_first, pad_last), (pad_first, pad_last)]
+
+        np_dtype = np.float32 if self.cache_dtype == 'float32' else np.uint8
+        # uint8 pixels = (X - cache_offset) / cache_scale, lossless for uint8 images
+        self.cache_scale, self.cache_offset = 1.0, 0.0
+        if self.cache_dtype == 'uint8' and np.asarray(self.np_img[:1]).dtype != np.uint8:
+            lo = min(float(np.min(self.np_img[i:i + chunk_size])) for i in range(0, n, chunk_size))
+            hi = max(float(np.max(self.np_img[i:i + chunk_size])) for i in range(0, n, chunk_size))
+            self.cache_offset = lo
+            self.cache_scale = (hi - lo) / 255 if hi > lo else 1.0
+        cache_img = torch.from_numpy(
+            np.empty((n, self.np_img.shape[3], self.out_size, self.out_size), dtype=np_dtype))
+        for i in range(0, n, chunk_size):
+            X = np.asarray(self.np_img[i:i + chunk_size])
+            if self.cache_dtype == 'float32':
+                X = X - self.mean_img
+            elif X.dtype != np.uint8:
+                X = np.rint((X - self.cache_offset) / self.cache_scale).clip(0, 255)
+            X = np.pad(np.moveaxis(X, -1, 1), pad_width, mode='reflect')
+            cache_img[i:i + chunk_size] = torch.from_numpy(X.astype(np_dtype))
+        self.cache_mean = None
+        if self.cache_dtype == 'uint8':
+            mean_img = np.pad(np.moveaxis(self.mean_img, -1, 0), pad_width[1:], mode='reflect')
+            self.cache_mean = torch.from_numpy(mean_img).float().share_memory_()
+
+        # masks are cached bit-packed, (n, 1276) uint8, unless they need resizing
+        if self.np_mask is None:
+            cache_mask = torch.zeros((n, (101*101 + 7)//8), dtype=torch.uint8)
+        elif isinstance(self.np_mask, PackedMasks):
+            cache_mask = torch.from_numpy(np.array(self.np_mask.packed))
+        elif self.np_mask.shape[1:3] == (101, 101):
+            # not binary (binary masks are packed above), so keep the fractions
+            cache_mask = torch.from_numpy(np.asarray(self.np_mask).reshape(n, 101, 101).astype(np.float32))
+        else:
+            from skimage import transform
+            cache_mask = torch.from_numpy(np.r_[
+                [transform.resize(e, (101, 101), mode='constant', preserve_range=True).squeeze()
+                 for e in self.np_mask]].astype(np.float32))
+
+        self.cache_img = cache_img.share_memory_()
+        self.cache_mask = cache_mask.share_memory_()
+        self.cache_depth = self.df_depth.iloc[:, 0].values
+        self.cached = True
 
     def __len__(self):
         return len(self.np_img)
 
+    @property
+    def binary_masks(self):
+        """True when every mask returned is exactly 0/1, i.e. the masks are
+        kept packed and no transform interpolates them."""
+        return not self.transform and (self.np_mask is None or isinstance(self.np_mask, PackedMasks))
+
+    def _cached_images(self, idx):
+        X = self.cache_img[idx]
+        if self.cache_mean is not None:
+            X = X.float()
+            if self.cache_scale != 1 or self.cache_offset != 0:
+                X = X * self.cache_scale + self.cache_offset
+            X = X - self.cache_mean
+        return X
+
+    def _cached_masks(self, idx):
+        masks = self.cache_mask[idx]
+        if self.cache_mask.dim() == 2:
+            # bit-packed, unpack all masks of idx at once
+            shape = tuple(masks.shape[:-1]) + (101, 101)
+            masks = torch.from_numpy(unpack_masks(masks.reshape(-1, masks.shape[-1]).numpy(), (101, 101)))
+            masks = masks.reshape(shape)
+        return masks.float().type(dtype)
+
+    def __getitems__(self, indices):
+        """Batched __getitem__, used by DataLoader to read a whole batch of
+        the cache at once."""
+        if not (self.cached and not self.transform):
+            return [self[idx] for idx in indices]
+        X = self._cached_images(indices).repeat(1,self.out_ch,1,1).type(dtype)
+        y = self._cached_masks(indices)
+        return list(zip(X, y, self.cache_depth[indices], indices))
+
     def __getitem__(self, idx):
+        if self.cached and not self.transform:
+            X = self._cached_images(idx).repeat(self.out_ch,1,1).type(dtype)
+            y = self._cached_masks(idx)
+            return (X,y,self.cache_depth[idx],idx)
 
         X_orig = self.np_img[idx]
         X = X_orig - self.mean_img
@@ -252,6 +498,7 @@ class SaltDataset(Dataset):
         #g()
         X = torch.from_numpy(X).float().type(dtype)
         X = X.repeat(self.out_ch,1,1)
+        from skimage import transform
         y = transform.resize(y, (101, 101), mode='constant', preserve_range=True)
         y = torch.from_numpy(y).float().squeeze().type(dtype)
 
@@ -289,38 +536,270 @@ class SaltNet(nn.Module):
         return torch.clamp(out[:,:,:-1,:-1].squeeze(), 0.0, 1.0)
 
 
-def load_all_data():
-    try:
-        print('Try loading data from npy and pickle files...')
-        np_train_all = np.load('./data/np_train_all.npy')
-        np_train_all_mask = np.load('./data/np_train_all_mask.npy')
-        np_test = np.concatenate([np.load('./data/np_test_0.npy'), np.load('./data/np_test_1.npy')])
-        with open('./data/misc_data.pickle', 'rb') as f:
-            misc_data = pickle.load(f)
-        print('Data loaded.')
-        return (np_train_all, np_train_all_mask, np_test, misc_data)
-
-    except:
-        print('npy files not found. Reload data from raw images...')
-        np_train_all, np_train_all_ids = load_img_to_np('./data/train/images')
-        np_train_all_mask, np_train_all_mask_ids = load_img_to_np('./data/train/masks')
-        df_train_all_depth = pd.read_csv('./data/depths.csv').set_index('id')
-        np_test, np_test_ids = load_img_to_np('./data/test/images')
-        np.save('./data/np_train_all.npy', np_train_all)
-        np.save('./data/np_train_all_mask.npy', np_train_all_mask)
-        for k, v in enumerate(np.split(np_test,2)):
-            np.save(f'./data/np_test_{k}.npy', v)
-        misc_data = {'df_train_all_depth': df_train_all_depth,
-                     'np_train_all_ids': np_train_all_ids,
-                     'np_train_all_mask_ids': np_train_all_mask_ids,
-                     'np_test_ids': np_test_ids}
-        with open('./data/misc_data.pickle', 'wb') as f:
-            pickle.dump(misc_data, f, protocol=pickle.HIGHEST_PROTOCOL)
-        print('Data loaded.')
-        return (np_train_all, np_train_all_mask, np_test, misc_data)
+class MmapConcat(object):
+    """Read-only concatenation of arrays along axis 0.
+
+    Used to join memory-mapped parts without copying them; only the rows
+    that are indexed are read.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.offsets = np.r_[0, np.cumsum([len(a) for a in arrays])]
+        self.shape = (int(self.offsets[-1]),) + tuple(arrays[0].shape[1:])
+        self.dtype = arrays[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        rest = ()
+        if isinstance(idx, tuple):
+            idx, rest = idx[0], idx[1:]
+        if not isinstance(idx, slice) and np.ndim(idx) == 0:
+            # ints, numpy and 0-d tensor scalars
+            idx = int(idx)
+            idx = idx + len(self) if idx < 0 else idx
+            if not 0 <= idx < len(self):
+                raise IndexError(f'index {idx} is out of bounds for axis 0 with size {len(self)}')
+            k = np.searchsorted(self.offsets, idx, side='right') - 1
+            out = self.arrays[k][idx - self.offsets[k]]
+            return out[rest] if rest else out
+        else:
+            if isinstance(idx, slice):
+                idx = np.arange(len(self))[idx]
+            idx = np.asarray(idx)
+            if idx.dtype == bool:
+                idx = np.nonzero(idx)[0]
+            idx = np.where(idx < 0, idx + len(self), idx)
+            parts = np.searchsorted(self.offsets, idx, side='right') - 1
+            out = np.empty((len(idx),) + self.shape[1:], dtype=self.dtype)
+            for k in np.unique(parts):
+                sel = parts == k
+                out[sel] = self.arrays[k][idx[sel] - self.offsets[k]]
+        return out[(slice(None),) + rest] if rest else out
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.concatenate([np.asarray(a) for a in self.arrays])
+        return out if dtype is None else out.astype(dtype)
+
+
+class SaltDataStore(object):
+    """Memory-mapped store of the npy caches under data_dir.
+
+    The image arrays are opened with mmap_mode so only the slices a caller
+    touches are read. Ids and depths are kept in a small json index which
+    also records the shape, dtype and size of every array, so a truncated
+    or stale cache is reported instead of being silently rebuilt. The masks
+    are stored bit-packed, with their foreground value in the index, and
+    loaded either as PackedMasks or unpacked to the uint8 array they were
+    built from.
+
+    Args:
+        data_dir (string): Folder with the npy files and the raw images.
+        mmap_mode (string): Passed to np.load. None loads arrays into RAM.
+    """
+    index_file = 'data_index.json'
+    array_files = {'np_train_all': ['np_train_all.npy'],
+                   'np_train_all_mask': ['np_train_all_mask_packed.npy'],
+                   'np_test': ['np_test_0.npy', 'np_test_1.npy']}
+    packed_arrays = {'np_train_all_mask': (101, 101)}
+    legacy_mask_file = 'np_train_all_mask.npy'
+    img_dirs = {'np_train_all_ids': 'train/images',
+                'np_train_all_mask_ids': 'train/masks',
+                'np_test_ids': 'test/images'}
+
+    def __init__(self, data_dir='./data', mmap_mode='r'):
+        self.data_dir = data_dir
+        self.mmap_mode = mmap_mode
+        self.index_path = os.path.join(data_dir, self.index_file)
+        self._index = None
+        # foreground value of the masks packed before the index is written
+        self.mask_values = {}
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    @property
+    def index(self):
+        if self._index is None:
+            with open(self.index_path, 'r') as f:
+                self._index = json.load(f)
+        return self._index
+
+    def _array_meta(self, fname):
+        arr = np.load(os.path.join(self.data_dir, fname), mmap_mode='r')
+        return {'shape': list(arr.shape), 'dtype': str(arr.dtype),
+                'size': os.path.getsize(os.path.join(self.data_dir, fname))}
+
+    def write_index(self, misc_data):
+        """Write the index for the npy files already in data_dir."""
+        df_depth = misc_data['df_train_all_depth']
+        index = {'arrays': {fname: self._array_meta(fname)
+                            for files in self.array_files.values() for fname in files},
+                 'depths': {'id': df_depth.index.tolist(), 'z': df_depth.iloc[:, 0].tolist(),
+                            'columns': [df_depth.index.name] + df_depth.columns.tolist()}}
+        for k in self.img_dirs:
+            index[k] = list(misc_data[k])
+        index['mask_values'] = dict(self.mask_values)
+        self._save_index(index)
+
+    def _save_index(self, index):
+        with open(self.index_path, 'w') as f:
+            json.dump(index, f)
+        self._index = index
+
+    def pack_legacy_masks(self, remove_legacy=False):
+        """Convert the uint8 mask npy of older caches to the packed format.
+
+        Nothing is done (and False returned) if there is no such file, if the
+        packed file already exists, or if it does not match the index so
+        check() can report it. The uint8 file is kept unless remove_legacy
+        is True.
+        """
+        legacy_path = os.path.join(self.data_dir, self.legacy_mask_file)
+        fname = self.array_files['np_train_all_mask'][0]
+        if not os.path.exists(legacy_path) or os.path.exists(os.path.join(self.data_dir, fname)):
+            return False
+        if self.exists() and self.index['arrays'].get(self.legacy_mask_file) != self._array_meta(self.legacy_mask_file):
+            return False
+        masks = np.load(legacy_path, mmap_mode='r')
+        self.mask_values['np_train_all_mask'] = _mask_value(masks)
+        np.save(os.path.join(self.data_dir, fname), PackedMasks.from_masks(masks).packed)
+        del masks
+        if self.exists():
+            index = self.index
+            del index['arrays'][self.legacy_mask_file]
+            index['arrays'][fname] = self._array_meta(fname)
+            index['mask_values'] = dict(index.get('mask_values', {}), **self.mask_values)
+            self._save_index(index)
+        if remove_legacy:
+            os.remove(legacy_path)
+        return True
+
+    def check(self, check_raw=True):
+        """Return a list of problems with the cache, empty if it is fresh."""
+        problems = []
+        for fname, meta in self.index['arrays'].items():
+            path = os.path.join(self.data_dir, fname)
+            if not os.path.exists(path):
+                problems.append(f'{fname} is missing')
+                continue
+            try:
+                current = self._array_meta(fname)
+            except ValueError as e:
+                problems.append(f'{fname} is corrupt: {e}')
+                continue
+            if current != meta:
+                problems.append(f'{fname} does not match the index: {current} != {meta}')
+        if check_raw:
+            for k, img_dir in self.img_dirs.items():
+                img_dir = os.path.join(self.data_dir, img_dir)
+                if os.path.isdir(img_dir):
+                    ids = [os.path.splitext(os.path.basename(f))[0]
+                           for f in sorted(glob.glob(f'{img_dir}/*.png'))]
+                    if ids != self.index[k]:
+                        problems.append(f'{img_dir} has changed since the cache was built')
+        return problems
+
+    def load_array(self, name, packed=False):
+        """The array name, packed arrays as PackedMasks if packed is True,
+        else unpacked to uint8 with their original foreground value."""
+        arrays = [np.load(os.path.join(self.data_dir, f), mmap_mode=self.mmap_mode)
+                  for f in self.array_files[name]]
+        if name in self.packed_arrays:
+            masks = PackedMasks(arrays[0], self.packed_arrays[name])
+            if packed:
+                return masks
+            # caches packed before the value was recorded hold 0/1 masks
+            return masks.unpack()[..., None] * np.uint8(self.index.get('mask_values', {}).get(name, 1))
+        if len(arrays) == 1:
+            return arrays[0]
+        if self.mmap_mode is None:
+            return np.concatenate(arrays)
+        return MmapConcat(arrays)
+
+    def load_misc_data(self):
+        import pandas as pd
+        depths = self.index['depths']
+        id_col, z_col = depths['columns']
+        misc_data = {'df_train_all_depth': pd.DataFrame({z_col: depths['z']},
+                                                        index=pd.Index(depths['id'], name=id_col))}
+        for k in self.img_dirs:
+            misc_data[k] = self.index[k]
+        return misc_data
+
+    def load(self, packed_masks=False):
+        return (self.load_array('np_train_all'), self.load_array('np_train_all_mask', packed=packed_masks),
+                self.load_array('np_test'), self.load_misc_data())
+
+    def build(self, refresh=False):
+        """Decode the raw images and write the npy files and the index.
+
+        With refresh=True the arrays already in the cache are reused and only
+        images added since it was built are decoded.
+        """
+        loaded = {}
+        for name in self.array_files:
+            prev = None
+            if refresh:
+                prev = (self.load_array(name), self.index[f'{name}_ids'])
+            loaded[name] = load_img_to_np(os.path.join(self.data_dir, self.img_dirs[f'{name}_ids']), prev=prev)
+            del prev
+        import pandas as pd
+        df_train_all_depth = pd.read_csv(os.path.join(self.data_dir, 'depths.csv')).set_index('id')
+        for name, (images, _) in loaded.items():
+            if name in self.packed_arrays:
+                self.mask_values[name] = _mask_value(images)
+                images = PackedMasks.from_masks(images).packed
+            files = self.array_files[name]
+            for fname, v in zip(files, np.array_split(images, len(files))):
+                np.save(os.path.join(self.data_dir, fname), v)
+        self.write_index({'df_train_all_depth': df_train_all_depth,
+                          'np_train_all_ids': loaded['np_train_all'][1],
+                          'np_train_all_mask_ids': loaded['np_train_all_mask'][1],
+                          'np_test_ids': loaded['np_test'][1]})
+
+
+def load_all_data(data_dir='./data', mmap_mode='r', rebuild=False, refresh=False, check_raw=True,
+                  packed_masks=False):
+    """Load the train/test arrays and misc data from the cache in data_dir.
+
+    The arrays are memory-mapped unless mmap_mode is None. The cache is built
+    from the raw images only when it does not exist or rebuild is True, and
+    refresh=True decodes only the images added since it was built. A corrupt
+    or stale cache raises a ValueError listing the problems. The train masks
+    are stored bit-packed and returned as the uint8 array they were built
+    from, or as PackedMasks (8x smaller, 0/1) with packed_masks=True.
+    """
+    store = SaltDataStore(data_dir, mmap_mode=mmap_mode)
+    if not rebuild and store.pack_legacy_masks():
+        print(f'Converted {store.legacy_mask_file} to bit-packed masks.')
+    legacy_pickle = os.path.join(data_dir, 'misc_data.pickle')
+    if not rebuild and not store.exists() and os.path.exists(legacy_pickle):
+        print('Creating data index from misc_data.pickle...')
+        with open(legacy_pickle, 'rb') as f:
+            store.write_index(pickle.load(f))
+    if rebuild or not store.exists():
+        print('Building data cache from raw images...')
+        store.build()
+    elif refresh:
+        print('Refreshing data cache with new raw images...')
+        store.build(refresh=True)
+    else:
+        print('Try loading data from npy files...')
+        problems = store.check(check_raw=check_raw)
+        if problems:
+            raise ValueError('Data cache in {} is stale or corrupt, call load_all_data(refresh=True) '
+                             'or load_all_data(rebuild=True) to update it:\n{}'.format(data_dir, '\n'.join(problems)))
+    print('Data loaded.')
+
+    return store.load(packed_masks=packed_masks)
 
 
 def rle_encoder2d(x):
+    import pandas as pd
     if isinstance(x, torch.Tensor):
         x = x.detach().numpy()
     s = pd.Series(x.clip(0,1).flatten('F'))
@@ -334,35 +813,357 @@ def rle_encoder2d(x):
 
 
 def rle_encoder3d(x):
-    return np.r_[[rle_encoder2d(e) for e in x]]
+    return np.r_[rle_encode_batch(x)]
+
+
+def rle_encode_batch(x):
+    """Run-length encode a batch of binary masks in one pass.
+
+    Produces the same strings as rle_encoder2d for each mask (pixels are
+    numbered top to bottom, then left to right, starting from 1).
+
+    Args:
+        x (ndarray or Tensor): Masks of shape (N, H, W) or (N, H, W, 1) as
+            returned by load_img_to_np. Any value > 0 is treated as
+            foreground.
+    Returns:
+        list of str: One rle string per mask, '' for an empty mask.
+    """
+    if isinstance(x, torch.Tensor):
+        x = x.cpu().detach().numpy()
+    x = np.asarray(x)
+    if x.ndim == 4 and x.shape[-1] == 1:
+        x = x[..., 0]
+    n = x.shape[0]
+    # Fortran order flattening of each mask, padded with a 0 on both sides
+    # so that every run has a start and an end in the diff.
+    flat = np.zeros((n, x[0].size + 2), dtype=np.int8)
+    flat[:, 1:-1] = (x > 0).transpose(0, 2, 1).reshape(n, -1)
+    d = np.diff(flat, axis=1)
+    rows, starts = np.nonzero(d == 1)
+    _, ends = np.nonzero(d == -1)
+    runs = np.empty((len(starts), 2), dtype=np.int64)
+    runs[:, 0] = starts + 1
+    runs[:, 1] = ends - starts
+    offsets = np.r_[0, np.cumsum(np.bincount(rows, minlength=n))]
+    runs = runs.astype(str)
+    rles = [' '.join(runs[offsets[k]:offsets[k+1]].ravel()) for k in range(n)]
+
+    return rles
+
+
+def rle_decode_batch(rles, shape=(101, 101)):
+    """Decode rle strings back into a batch of masks.
+
+    Args:
+        rles (list of str): rle strings as produced by rle_encode_batch.
+        shape (tuple): (H, W) of each mask.
+    Returns:
+        ndarray: uint8 masks of shape (N, H, W).
+    """
+    h, w = shape
+    n = len(rles)
+    size = h * w
+    # +1 at every run start and -1 after every run end, then cumsum.
+    marks = np.zeros(n * size + 1, dtype=np.int8)
+    for k, rle in enumerate(rles):
+        if isinstance(rle, str) and rle.strip():
+            runs = np.array(rle.split(), dtype=np.int64).reshape(-1, 2)
+            starts = runs[:, 0] - 1 + k * size
+            np.add.at(marks, starts, 1)
+            np.add.at(marks, starts + runs[:, 1], -1)
+    masks = np.cumsum(marks[:-1], dtype=np.int8).astype(np.uint8)
+
+    return masks.reshape(n, w, h).transpose(0, 2, 1)
+
+
+class RleCsvWriter(object):
+    """Stream 'id,rle_mask' rows to a submission csv.
+
+    Args:
+        out_file (string): Path of the csv file to write.
+        batch_size (int): Number of masks encoded per batch.
+    """
+
+    def __init__(self, out_file, batch_size=1000):
+        self.out_file = out_file
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self.f = open(out_file, 'w', newline='')
+        self.f.write('id,rle_mask\n')
+
+    def write(self, ids, masks):
+        for i in range(0, len(ids), self.batch_size):
+            rles = rle_encode_batch(masks[i:i + self.batch_size])
+            batch_ids = ids[i:i + self.batch_size]
+            self.f.write(''.join(f'{img_id},{rle}\n' for img_id, rle in zip(batch_ids, rles)))
+            self.rows_written += len(rles)
+
+    def close(self):
+        if not self.f.closed:
+            self.f.close()
 
+    def __enter__(self):
+        return self
 
-def load_img_to_np(img_path, num_channel=1):
-    images = []
-    img_ids = []
-    for filename in sorted(glob.glob(f'{img_path}/*.png')): #assuming png
-        img_id = filename.split('\\')[-1].split('.')[0]
-        img_ids.append(img_id)
-        images.append(np.array(imageio.imread(filename), dtype=np.uint8).reshape(101,101,-1)[:,:,0:num_channel])
-    return (np.r_[images], img_ids)
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_rle_submission(ids, masks, out_file, batch_size=1000):
+    """Encode masks of shape (N, H, W) batch by batch and write them to
+    out_file as a submission csv. masks can be a memory-mapped array."""
+    with RleCsvWriter(out_file, batch_size=batch_size) as writer:
+        writer.write(ids, masks)
+    print(f'{writer.rows_written} rows written to {out_file}.')
+
+    return out_file
+
+
+def _decode_png_chunk(filenames, num_channel):
+    # runs in a worker process of load_img_to_np
+    import imageio
+    return np.stack([np.array(imageio.imread(f), dtype=np.uint8).reshape(101,101,-1)[:,:,0:num_channel]
+                     for f in filenames])
+
+
+def load_img_to_np(img_path, num_channel=1, n_jobs=None, chunk_size=256, prev=None, verbose=True):
+    """Decode all png files in img_path into a uint8 array of shape
+    (N, 101, 101, num_channel), sorted by file name.
+
+    Args:
+        img_path (string): Folder with the png files.
+        num_channel (int): Number of channels to keep.
+        n_jobs (int): Number of decoding processes, defaults to the cpu count.
+            They are spawned, so a script calling this with n_jobs > 1 needs
+            an if __name__ == '__main__' guard.
+        chunk_size (int): Number of files decoded per task.
+        prev (tuple, optional): (images, img_ids) from an earlier call. Images
+            whose id is in prev are copied from it and only new files are
+            decoded.
+        verbose (bool): Print progress.
+    Returns:
+        tuple: (images, img_ids)
+    """
+    filenames = sorted(glob.glob(f'{img_path}/*.png')) #assuming png
+    img_ids = [os.path.splitext(os.path.basename(f))[0] for f in filenames]
+    images = np.empty((len(filenames), 101, 101, num_channel), dtype=np.uint8)
+
+    todo = np.arange(len(filenames))
+    if prev is not None:
+        prev_images, prev_ids = prev
+        prev_pos = {img_id: k for k, img_id in enumerate(prev_ids)}
+        known = np.array([img_id in prev_pos for img_id in img_ids], dtype=bool)
+        if known.any():
+            images[known] = np.asarray(prev_images)[[prev_pos[img_ids[k]] for k in np.nonzero(known)[0]]]
+        todo = todo[~known]
+        if verbose:
+            print(f'{known.sum()} images reused, {len(todo)} new images to decode.')
+
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    n_jobs = n_jobs or os.cpu_count() or 1
+    done = 0
+    if n_jobs == 1 or len(chunks) <= 1:
+        results = (_decode_png_chunk([filenames[k] for k in c], num_channel) for c in chunks)
+        pool = None
+    else:
+        # spawn, like cross_validate and PlotSink: forking after torch is imported is not safe
+        pool = ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context('spawn'))
+        results = pool.map(_decode_png_chunk, [[filenames[k] for k in c] for c in chunks],
+                           [num_channel] * len(chunks))
+    try:
+        for c, decoded in zip(chunks, results):
+            images[c] = decoded
+            done += len(c)
+            if verbose:
+                print(f'\r{img_path}: {done}/{len(todo)} images decoded', end='')
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if verbose and len(todo):
+        print()
+
+    return (images, img_ids)
 
 
 def load_single_img(path, show=False):
+    import imageio
     img = np.array(imageio.imread(path), dtype=np.uint8)
     if show:
+        import matplotlib.pyplot as plt
         plt.imshow(img, cmap='gray')
     return img
 
 
+_POPCOUNT_TABLE = np.array([bin(k).count('1') for k in range(256)], dtype=np.uint8)
+
+
+def _to_numpy(x):
+    # no copy for tensors already on cpu
+    if isinstance(x, torch.Tensor):
+        x = x.detach()
+        return x.numpy() if x.device.type == 'cpu' else x.cpu().numpy()
+    return np.asarray(x)
+
+
+def _is_binary(x):
+    return x.dtype == bool or np.issubdtype(x.dtype, np.integer) or bool(((x <= 0) | (x >= 1)).all())
+
+
+def popcount(x):
+    """Number of set bits of every element of a uint8 array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return _POPCOUNT_TABLE[x]
+
+
+def _mask_value(masks, chunk_size=4096):
+    # foreground value of binary masks, e.g. 255 for masks decoded from png
+    value = max([int(np.max(masks[i:i + chunk_size])) for i in range(0, len(masks), chunk_size)] or [1])
+    return value or 1
+
+
+def pack_masks(x):
+    """Bit-pack a batch of binary masks.
+
+    Args:
+        x (ndarray or Tensor): (N, H, W) masks, values > 0 are foreground.
+    Returns:
+        ndarray: uint8 (N, ceil(H*W/8)) packed masks.
+    """
+    x = _to_numpy(x)
+    return np.packbits(x.reshape(len(x), -1) > 0, axis=1)
+
+
+def unpack_masks(x, shape=(101, 101)):
+    """Inverse of pack_masks, returns uint8 (N, H, W) masks."""
+    size = shape[0] * shape[1]
+    return np.unpackbits(x, axis=1, count=size).reshape((len(x),) + tuple(shape))
+
+
+class PackedMasks(np.lib.mixins.NDArrayOperatorsMixin):
+    """Binary masks kept bit-packed with pack_masks, 8x smaller than uint8.
+
+    Indexing works like the (N, H, W, 1) uint8 0/1 mask array it replaces:
+    an int returns one unpacked mask, slices and index arrays return a
+    PackedMasks of the selected rows without unpacking them, and further
+    indices (m[idx, ...], m[:, :, :, 0]) are applied to the unpacked rows.
+    Arithmetic, comparisons, ufuncs and the reductions in _ARRAY_METHODS
+    work on the unpacked array. packed can be a memory-mapped array.
+
+    Args:
+        packed (ndarray): uint8 (N, ceil(H*W/8)) as returned by pack_masks.
+        mask_shape (tuple): (H, W) of a mask.
+    """
+
+    def __init__(self, packed, mask_shape=(101, 101)):
+        self.packed = packed
+        self.mask_shape = tuple(mask_shape)
+        self.shape = (len(packed),) + self.mask_shape + (1,)
+        self.dtype = np.dtype(np.uint8)
+        self.ndim = 4
+        self.size = int(np.prod(self.shape))
+
+    @classmethod
+    def from_masks(cls, masks, chunk_size=4096):
+        """Pack (N, H, W) or (N, H, W, 1) masks, values > 0 are foreground."""
+        masks = masks if isinstance(masks, torch.Tensor) else np.asarray(masks)
+        mask_shape = tuple(masks.shape[1:3])
+        packed = np.concatenate([pack_masks(masks[i:i + chunk_size]) for i in range(0, len(masks), chunk_size)]
+                                or [np.empty((0, (mask_shape[0]*mask_shape[1] + 7)//8), dtype=np.uint8)])
+        return cls(packed, mask_shape)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, idx):
+        rest = ()
+        if isinstance(idx, tuple):
+            idx, rest = (idx[0], idx[1:]) if idx else (slice(None), ())
+        if idx is Ellipsis:
+            idx, rest = slice(None), (Ellipsis,) + rest
+        # indices after the rows that keep everything, e.g. m[idx, ...] or m[idx, :]
+        rest = () if all(r is Ellipsis or (isinstance(r, slice) and r == slice(None)) for r in rest) else rest
+        if not isinstance(idx, slice) and np.ndim(idx) == 0:
+            # ints, numpy and 0-d tensor scalars
+            idx = int(idx)
+            idx = idx + len(self) if idx < 0 else idx
+            if not 0 <= idx < len(self):
+                raise IndexError(f'index {idx} is out of bounds for axis 0 with size {len(self)}')
+            out = self.unpack(slice(idx, idx + 1))[0, :, :, None]
+            return out[rest] if rest else out
+        out = PackedMasks(self.packed[_to_numpy(idx) if isinstance(idx, torch.Tensor) else idx], self.mask_shape)
+        return np.asarray(out)[(slice(None),) + rest] if rest else out
+
+    def unpack(self, idx=slice(None)):
+        """uint8 (n, H, W) masks of the rows idx, unpacked in one call."""
+        return unpack_masks(np.asarray(self.packed[idx]), self.mask_shape)
+
+    def clip(self, a_min, a_max):
+        # already 0/1
+        return self
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.unpack()[..., None]
+        return out if dtype is None else out.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [np.asarray(x) if isinstance(x, PackedMasks) else x for x in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    # ndarray methods run on the unpacked (N, H, W, 1) array
+    _ARRAY_METHODS = {'sum', 'mean', 'std', 'min', 'max', 'any', 'all', 'argmax', 'argmin', 'nonzero',
+                      'astype', 'reshape', 'squeeze', 'transpose', 'ravel', 'flatten', 'copy', 'tolist'}
+
+    def __getattr__(self, name):
+        if name in PackedMasks._ARRAY_METHODS:
+            return getattr(np.asarray(self), name)
+        raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
+
+
+def _packed_or_none(x):
+    # packed bits of x for the popcount IoU, None if x is not binary
+    if isinstance(x, PackedMasks):
+        return np.asarray(x.packed)
+    x = _to_numpy(x)
+    return pack_masks(x) if _is_binary(x) else None
+
+
+def _dense(x):
+    return x.unpack() if isinstance(x, PackedMasks) else _to_numpy(x)
+
+
+def calc_packed_iou(a, b, chunk_size=4096):
+    """calc_raw_iou of masks packed with pack_masks.
+
+    Intersection and union are popcounts of a & b and a | b, computed on
+    chunk_size images at a time.
+    """
+    i = np.empty(len(a), dtype=np.float64)
+    u = np.empty(len(a), dtype=np.float64)
+    for k in range(0, len(a), chunk_size):
+        a_k, b_k = a[k:k + chunk_size], b[k:k + chunk_size]
+        i[k:k + chunk_size] = popcount(a_k & b_k).sum(1, dtype=np.int64)
+        u[k:k + chunk_size] = popcount(a_k | b_k).sum(1, dtype=np.int64)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        iou = np.where(i==u, 1, np.where(u==0, 0, i/u))
+
+    return iou
+
+
 def calc_raw_iou(a, b):
-    if isinstance(a, torch.Tensor):
-        a = a.cpu().detach().numpy()
-    if isinstance(b, torch.Tensor):
-        b = b.cpu().detach().numpy()
+    packed_a = _packed_or_none(a)
+    packed_b = _packed_or_none(b) if packed_a is not None else None
+    if packed_b is not None:
+        # after clipping to [0, 1] both masks only hold 0 and 1
+        return calc_packed_iou(packed_a, packed_b)
+
+    a = _dense(a)
+    b = _dense(b)
     a = np.clip(a, 0, 1)
     b = np.clip(b, 0, 1)
-    u = np.sum(np.clip(a+b, 0, 1), (1,2)).astype(np.float)
-    i = np.sum(np.where((a+b)==2, 1, 0), (1,2)).astype(np.float)
+    u = np.sum(np.clip(a+b, 0, 1), (1,2)).astype(np.float64)
+    i = np.sum(np.where((a+b)==2, 1, 0), (1,2)).astype(np.float64)
     with np.errstate(divide='ignore',invalid='ignore'):
         iou = np.where(i==u, 1, np.where(u==0, 0, i/u))
 
@@ -377,6 +1178,71 @@ def calc_mean_iou(a, b):
     return iou_mean
 
 
+class IouAccumulator(object):
+    """Streaming calc_mean_iou and calc_clf_accuracy over many batches.
+
+    Per-image intersection/union and pixel accuracy counters are updated on
+    the device of the inputs, so memory does not grow with the number of
+    batches and there is no device sync until the results are read.
+    """
+    thresholds = [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.iou_score = None
+        self.n_images = 0
+        self.correct = None
+        self.n_pixels = 0
+
+    @torch.no_grad()
+    def update(self, a, b):
+        """Add a batch, a and b as passed to calc_mean_iou. Two bool masks
+        skip the conversion to float64."""
+        if a.dim() == 2:
+            a, b = a.unsqueeze(0), b.unsqueeze(0)
+        if a.dtype == torch.bool and b.dtype == torch.bool:
+            a = a.detach().reshape(a.shape[0], -1)
+            b = b.detach().to(a.device).reshape(b.shape[0], -1)
+            correct = (a == b).sum()
+            u = (a | b).sum(1).double()
+            i = (a & b).sum(1).double()
+        else:
+            a = a.detach().double()
+            b = b.detach().to(a.device).double()
+            correct = (a == b).sum()
+            a = a.reshape(a.shape[0], -1).clamp(0, 1)
+            b = b.reshape(b.shape[0], -1).clamp(0, 1)
+            s = a + b
+            u = s.clamp(0, 1).sum(1)
+            i = (s == 2).sum(1).double()
+        iou = torch.where(i == u, torch.ones_like(u), torch.where(u == 0, torch.zeros_like(u), i / u))
+        thresholds = torch.tensor(self.thresholds, dtype=torch.float64, device=a.device)
+        iou_score = (iou[:, None] > thresholds).double().mean(1).sum()
+
+        self.iou_score = iou_score if self.iou_score is None else self.iou_score + iou_score
+        self.correct = correct if self.correct is None else self.correct + correct
+        self.n_images += a.shape[0]
+        self.n_pixels += a.numel()
+
+    def all_reduce(self):
+        """Sum the counters over all processes of the default process group,
+        so every rank reports the metrics of the whole dataset."""
+        counts = torch.tensor([0. if self.iou_score is None else self.iou_score.item(), self.n_images,
+                               0. if self.correct is None else self.correct.item(), self.n_pixels],
+                              dtype=torch.float64)
+        dist.all_reduce(counts)
+        self.iou_score, self.n_images = counts[0], int(counts[1].item())
+        self.correct, self.n_pixels = counts[2], int(counts[3].item())
+
+    def mean_iou(self):
+        return self.iou_score.item() / self.n_images
+
+    def accuracy(self):
+        return self.correct.item() / self.n_pixels
+
+
 def timeSince(since):
     now = time.time()
     s = now - since
@@ -386,6 +1252,7 @@ def timeSince(since):
 
 
 def get_current_time_as_fname():
+        import pytz
         timestamp = (
                 dt.datetime.now(pytz.timezone('Australia/Melbourne'))
                 .strftime('%Y_%m_%d_%H_%M_%S')
@@ -394,7 +1261,7 @@ def get_current_time_as_fname():
         return timestamp
 
 
-def plot_img_mask_pred(images, labels=None, img_per_line=8):
+def plot_img_mask_pred(images, labels=None, img_per_line=8, out_file=None):
     images = [i.cpu().detach().numpy().squeeze() if isinstance(i, torch.Tensor) else i.squeeze() for i in images]
     num_img = len(images)
     if labels is None:
@@ -402,9 +1269,15 @@ def plot_img_mask_pred(images, labels=None, img_per_line=8):
 
     rows = np.ceil(num_img/img_per_line).astype(int)
     cols = min(img_per_line, num_img)
-    f, axarr = plt.subplots(rows,cols)
-    if rows==1:
-        axarr = axarr.reshape(1,-1)
+    if out_file is None:
+        import matplotlib.pyplot as plt
+        f, axarr = plt.subplots(rows,cols)
+    else:
+        # no pyplot, so this also works in a background process without a display
+        from matplotlib.figure import Figure
+        f = Figure()
+        axarr = f.subplots(rows,cols)
+    axarr = np.array(axarr).reshape(rows,cols)
     f.set_figheight(3*min(img_per_line, num_img)//cols*rows)
     f.set_figwidth(3*min(img_per_line, num_img))
     for i in range(num_img):
@@ -414,7 +1287,63 @@ def plot_img_mask_pred(images, labels=None, img_per_line=8):
         axarr[r,c].grid()
         axarr[r,c].set_title(labels[i])
 
-    plt.show()
+    if out_file is None:
+        plt.show()
+    else:
+        f.savefig(out_file)
+        return out_file
+
+
+class PlotSink(object):
+    """Destination of the sample plots made by train_model.
+
+    Args:
+        mode (string): 'inline' shows them with plot_img_mask_pred as before,
+            'background' saves them as png grids in out_dir from a worker
+            process, 'off' skips them.
+        out_dir (string): Folder for the png files in background mode.
+        max_pending (int): In background mode, plots are dropped rather than
+            queued when this many are still being rendered.
+    """
+
+    def __init__(self, mode='inline', out_dir='./plots', max_pending=2):
+        assert mode in ['inline', 'background', 'off']
+        self.mode = mode
+        self.out_dir = out_dir
+        self.max_pending = max_pending
+        self.pending = []
+        self.executor = None
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def plot(self, images, labels=None, name='plot'):
+        """Plot a few images, tensors are copied to cpu numpy arrays here."""
+        if self.mode == 'off':
+            return None
+        if self.mode == 'inline':
+            return plot_img_mask_pred(images, labels)
+
+        self.pending = [p for p in self.pending if not p.done()]
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return None
+        images = [i.detach().cpu().numpy() if isinstance(i, torch.Tensor) else np.asarray(i) for i in images]
+        if self.executor is None:
+            os.makedirs(self.out_dir, exist_ok=True)
+            # spawn, forking the training process would copy its torch threads and CUDA state
+            self.executor = ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn'))
+        out_file = os.path.join(self.out_dir, f'{name}_{get_current_time_as_fname()}_{time.time_ns() % 10**9}.png')
+        self.pending.append(self.executor.submit(plot_img_mask_pred, images, labels, out_file=out_file))
+        return out_file
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.pending = []
 
 
 def adjust_predictions(zero_mask_cut_off, X, y_pred, y=None):
@@ -431,42 +1360,215 @@ def adjust_predictions(zero_mask_cut_off, X, y_pred, y=None):
     y_pred_adj[black_img_mask]=0
 
     # set all predictions to 0 if the number of positive predictions is less than ZERO_MASK_CUTOFF
-    y_pred_adj = np.r_[[e if e.sum()>zero_mask_cut_off else np.zeros_like(e) for e in y_pred_adj]]
+    y_pred_adj[y_pred_adj.reshape(len(y_pred_adj), -1).sum(1) <= zero_mask_cut_off] = 0
 
     if y is not None:
         log.info(f'IOU score before: {calc_mean_iou(y_pred, y)}, IOU Score after:{calc_mean_iou(y_pred_adj, y)}')
 
     return y_pred_adj
 
+def search_threshold_cutoff(y_prob, y, X=None, thresholds=None, cut_offs=None, chunk_size=512):
+    """Grid search the probability threshold and zero_mask_cut_off on cached
+    validation probabilities.
+
+    Every image's probabilities are bucketed between the sorted thresholds
+    once, which gives the positive pixel count and intersection for all
+    thresholds; adjust_predictions is then applied to the counts for every
+    cut off and the competition IOU is computed for the whole grid.
+
+    Args:
+        y_prob (ndarray or Tensor): (N, H, W) predicted probabilities.
+        y (ndarray or Tensor): (N, H, W) binary true masks.
+        X (ndarray, optional): (N, H, W, C) images, black images are
+            predicted empty as in adjust_predictions.
+        thresholds (list): Probability thresholds, a pixel is positive if its
+            probability is >= the threshold.
+        cut_offs (list): zero_mask_cut_off values.
+        chunk_size (int): Number of images counted at a time.
+    Returns:
+        tuple: (best threshold, best cut off, best score, DataFrame of the
+            mean IOU with thresholds as index and cut offs as columns)
+    """
+    if isinstance(y_prob, torch.Tensor):
+        y_prob = y_prob.cpu().detach().numpy()
+    if isinstance(y, torch.Tensor):
+        y = y.cpu().detach().numpy()
+    if isinstance(X, torch.Tensor):
+        X = X.cpu().detach().numpy()
+    if thresholds is None:
+        thresholds = np.round(np.arange(0.2, 0.81, 0.05), 2)
+    if cut_offs is None:
+        cut_offs = np.arange(0, 301, 25)
+    thresholds = np.sort(np.asarray(thresholds))
+    cut_offs = np.asarray(cut_offs)
+    n, t = len(y_prob), len(thresholds)
+    # compare in the dtype of the probabilities, as y_prob >= threshold does
+    thr = thresholds.astype(np.asarray(y_prob[:1]).dtype)
+
+    pos = np.empty((n, t), dtype=np.int64)
+    inter = np.empty((n, t), dtype=np.int64)
+    true_sum = np.empty(n, dtype=np.int64)
+    for i in range(0, n, chunk_size):
+        p = np.asarray(y_prob[i:i + chunk_size])
+        b = len(p)
+        p = p.reshape(b, -1).clip(0, 1)
+        y_true = (np.asarray(y[i:i + chunk_size]).reshape(b, -1).clip(0, 1) == 1)
+        # number of thresholds <= p, i.e. p >= thresholds[:k]
+        k = np.digitize(p, thr) + np.arange(b)[:, None] * (t + 1)
+        counts = np.bincount(k.ravel(), minlength=b * (t + 1)).reshape(b, t + 1)
+        counts_true = np.bincount(k[y_true], minlength=b * (t + 1)).reshape(b, t + 1)
+        pos[i:i + b] = np.cumsum(counts[:, ::-1], 1)[:, ::-1][:, 1:]
+        inter[i:i + b] = np.cumsum(counts_true[:, ::-1], 1)[:, ::-1][:, 1:]
+        true_sum[i:i + b] = y_true.sum(1)
+
+    # (T, C, N) counts after adjust_predictions
+    zero = pos[None] <= cut_offs[:, None, None]
+    if X is not None:
+        zero = zero | (np.asarray(X).mean((1, 2, 3)) == 0)[None, :, None]
+    i_grid = np.where(zero, 0, inter[None]).transpose(2, 0, 1).astype(np.float64)
+    u_grid = (np.where(zero, 0, pos[None]).transpose(2, 0, 1) + true_sum[None, None] - i_grid)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(i_grid == u_grid, 1, np.where(u_grid == 0, 0, i_grid / u_grid))
+    iou_thresholds = np.array([0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95])
+    scores = (iou[..., None] > iou_thresholds).mean(-1).mean(-1)
+
+    import pandas as pd
+    scores = pd.DataFrame(scores, index=pd.Index(thresholds, name='threshold'),
+                          columns=pd.Index(cut_offs, name='zero_mask_cut_off'))
+    best_t, best_c = np.unravel_index(np.argmax(scores.values), scores.shape)
+
+    return thresholds[best_t], cut_offs[best_c], scores.values[best_t, best_c], scores
+
+
 def show_img_grid():
     pass
     #plt.imshow(torchvision.utils.make_grid(torch.from_numpy(y_train_black).unsqueeze(1)).permute(1, 2, 0))
 
 
+class ChunkedFileReader(RawIOBase):
+    """Read-only, seekable file object over the chunk files of filePrefix.
+
+    The chunks are read on demand, so torch.load can read a chunked
+    checkpoint without joining it in memory first. If a manifest written by
+    ChunkedFileWriter exists the chunk sizes are checked against it, and
+    with verify=True the sha256 of every chunk as well.
+    """
+
+    def __init__(self, filePrefix, filePath, verify=True):
+        super().__init__()
+        manifest_path = chunk_manifest_path(filePrefix, filePath)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            # chunks are next to the manifest
+            self.paths = [os.path.join(os.path.dirname(manifest_path), c['name']) for c in manifest['chunks']]
+            self.check(manifest, verify)
+        else:
+            chunk_files = glob.glob(f'{filePath}/{filePrefix}-chunk-*-Of-*')
+            if not chunk_files:
+                raise FileNotFoundError(f'No chunk files found for {filePath}/{filePrefix}')
+            noOfChunks = int(chunk_files[0].split('-')[-1])
+            self.paths = [f"{filePath}/{filePrefix}-chunk-{j}-Of-{noOfChunks}" for j in range(1, noOfChunks + 1)]
+        self.sizes = [os.path.getsize(p) for p in self.paths]
+        self.offsets = np.r_[0, np.cumsum(self.sizes)].tolist()
+        self.pos = 0
+        self.f = None
+        self.f_idx = None
+
+    def check(self, manifest, verify):
+        for path, chunk in zip(self.paths, manifest['chunks']):
+            if not os.path.exists(path):
+                raise ValueError(f'Chunk {path} is missing')
+            if os.path.getsize(path) != chunk['size']:
+                raise ValueError(f"Chunk {path} has {os.path.getsize(path)} bytes, expected {chunk['size']}")
+            if verify:
+                sha256 = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        sha256.update(block)
+                if sha256.hexdigest() != chunk['sha256']:
+                    raise ValueError(f'Chunk {path} does not match the checksum in the manifest')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_SET:
+            self.pos = offset
+        elif whence == SEEK_CUR:
+            self.pos += offset
+        elif whence == SEEK_END:
+            self.pos = self.offsets[-1] + offset
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.offsets[-1]:
+            return 0
+        k = bisect.bisect_right(self.offsets, self.pos) - 1
+        if k != self.f_idx:
+            if self.f is not None:
+                self.f.close()
+            self.f = open(self.paths[k], 'rb')
+            self.f_idx = k
+        self.f.seek(self.pos - self.offsets[k])
+        n = self.f.readinto(memoryview(b)[:self.offsets[k + 1] - self.pos])
+        self.pos += n
+        return n
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        super().close()
+
+
+def load_model_state_from_chunks(out_file_prefix, outputFolder, map_location=None, keys=None, verify=True,
+                                 **kwargs):
+    """torch.load a checkpoint saved by save_model_state_to_chunks directly
+    from its chunk files.
+
+    Args:
+        map_location: Passed to torch.load.
+        keys (list, optional): Only return these keys of the state, e.g.
+            ['model']. This only filters the result, the whole checkpoint
+            is still read and deserialized.
+        verify (bool): Check the chunk checksums in the manifest.
+    """
+    with ChunkedFileReader(out_file_prefix, outputFolder, verify=verify) as f:
+        state = torch.load(BufferedReader(f, buffer_size=1 << 20), map_location=map_location, **kwargs)
+    if keys is not None:
+        state = {k: state[k] for k in keys}
+
+    return state
+
+
 def join_files(filePrefix, filePath, newFileName=None, returnFileObject=False, removeChunks=False):
-    noOfChunks = int(glob.glob(f'{filePath}/{filePrefix}*')[0].split('-')[-1])
-    dataList = []
-    j = 0
-    for i in range(0, noOfChunks, 1):
-        j += 1
-        chunkName = f"{filePath}/{filePrefix}-chunk-{j}-Of-{noOfChunks}"
-        f = open(chunkName, 'rb')
-        dataList.append(f.read())
-        f.close()
-        if removeChunks:
-            os.remove(chunkName)
+    reader = ChunkedFileReader(filePrefix, filePath, verify=False)
+    if returnFileObject and not removeChunks:
+        return BufferedReader(reader, buffer_size=1 << 20)
 
     if returnFileObject:
+        # the chunks are removed below, so read them into memory first
         fileOut = BytesIO()
-        for data in dataList:
-            fileOut.write(data)
+    else:
+        fileOut = open(newFileName, 'wb')
+    shutil.copyfileobj(reader, fileOut, 1 << 20)
+    reader.close()
+    if removeChunks:
+        for chunkName in reader.paths:
+            os.remove(chunkName)
+
+    if returnFileObject:
         fileOut.seek(0)
         return fileOut
     else:
-        fileOut = open(newFileName, 'wb')
-        for data in dataList:
-            fileOut.write(data)
-        f2.close()
+        fileOut.close()
         print(f'File parts merged to {newFileName} successfully.')
 
 
@@ -507,6 +1609,102 @@ def split_file_save(inputFile, outputFilePrefix, outputFolder, chunkSize=1000000
 
 
 
+def chunk_manifest_path(out_file_prefix, outputFolder):
+    return f'{outputFolder}/{out_file_prefix}-manifest.json'
+
+
+class ChunkedFileWriter(object):
+    """Write-only file object that splits everything written to it into
+    files of chunk_size bytes named {prefix}-chunk-{j}-Of-{n}.
+
+    Chunks are written as .part files and renamed once the total number of
+    chunks is known. close() also writes a json manifest with the size and
+    sha256 of every chunk and removes older chunks of the same prefix.
+    abort() removes the .part files and leaves an older checkpoint as it is.
+    """
+
+    def __init__(self, out_file_prefix, outputFolder, chunk_size=40000000):
+        self.out_file_prefix = out_file_prefix
+        self.outputFolder = outputFolder
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.f = None
+        self.pos = 0
+
+    def _next_chunk(self):
+        self._close_chunk()
+        path = f'{self.outputFolder}/{self.out_file_prefix}-chunk-{len(self.chunks) + 1}.part'
+        self.f = open(path, 'wb')
+        self.chunks.append({'path': path, 'size': 0, 'sha256': hashlib.sha256()})
+
+    def _close_chunk(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def write(self, b):
+        b = memoryview(b).cast('B')
+        written = 0
+        while written < len(b):
+            if self.f is None or self.chunks[-1]['size'] == self.chunk_size:
+                self._next_chunk()
+            chunk = self.chunks[-1]
+            part = b[written:written + self.chunk_size - chunk['size']]
+            self.f.write(part)
+            chunk['sha256'].update(part)
+            chunk['size'] += len(part)
+            written += len(part)
+        self.pos += written
+        return written
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def close(self):
+        """Finish the chunks and write the manifest, returns the chunk names."""
+        self._close_chunk()
+        n = len(self.chunks)
+        chunk_names = [f'{self.out_file_prefix}-chunk-{j}-Of-{n}' for j in range(1, n + 1)]
+        for chunk, name in zip(self.chunks, chunk_names):
+            os.replace(chunk['path'], f'{self.outputFolder}/{name}')
+        for old in glob.glob(f'{self.outputFolder}/{self.out_file_prefix}-chunk-*'):
+            if os.path.basename(old) not in [os.path.basename(e) for e in chunk_names]:
+                os.remove(old)
+        manifest = {'total_size': self.pos,
+                    'chunks': [{'name': os.path.basename(name), 'size': chunk['size'],
+                                'sha256': chunk['sha256'].hexdigest()}
+                               for chunk, name in zip(self.chunks, chunk_names)]}
+        manifest_path = chunk_manifest_path(self.out_file_prefix, self.outputFolder)
+        with open(manifest_path + '.part', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path + '.part', manifest_path)
+
+        return chunk_names
+
+    def abort(self):
+        """Remove the chunks written so far, older chunks and manifest are kept."""
+        self._close_chunk()
+        for chunk in self.chunks:
+            if os.path.exists(chunk['path']):
+                os.remove(chunk['path'])
+        self.chunks = []
+
+
+def snapshot_state(obj):
+    """Copy a (nested) state dict with every tensor cloned to CPU once."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_state(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_state(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
 def save_model_state_to_chunks(epoch, model_state, optim_state, scheduler_state, stats, out_file_prefix, outputFolder, chunk_size=40000000):
     if out_file_prefix is None:
         return 'Model state is not saved as the out_file_prefix is None'
@@ -516,15 +1714,757 @@ def save_model_state_to_chunks(epoch, model_state, optim_state, scheduler_state,
              'optimizer': optim_state,
              'scheduler': scheduler_state,
              'stats': stats}
-    output = BytesIO()
-    torch.save(state, output)
-    output.seek(0)
+    # serialize straight into the chunk files, no in-memory copy of the archive
+    output = ChunkedFileWriter(out_file_prefix, outputFolder, chunk_size=chunk_size)
+    try:
+        torch.save(state, output)
+    except BaseException:
+        # a half written archive must not replace the previous checkpoint
+        output.abort()
+        raise
+    chunk_names = output.close()
+
+    return chunk_names
+
+
+class AsyncCheckpointWriter(object):
+    """Run save_model_state_to_chunks in a background thread.
+
+    save() snapshots the states to CPU on the calling thread and returns
+    straight away. Only one write is in flight at a time, a new save()
+    first waits for the previous one.
+    """
+
+    def __init__(self, log=None):
+        self.log = log
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def save(self, epoch, model_state, optim_state, scheduler_state, stats, out_file_prefix, outputFolder,
+             chunk_size=40000000):
+        self.wait()
+        args = (epoch, snapshot_state(model_state), snapshot_state(optim_state),
+                snapshot_state(scheduler_state), snapshot_state(stats), out_file_prefix, outputFolder, chunk_size)
+        self.future = self.executor.submit(save_model_state_to_chunks, *args)
+        return args
+
+    def wait(self):
+        """Block until the pending write is done and return its result."""
+        if self.future is None:
+            return None
+        future, self.future = self.future, None
+        result = future.result()
+        if self.log is not None:
+            self.log.info(result)
+        return result
+
+    def close(self):
+        result = self.wait()
+        self.executor.shutdown()
+        return result
+
+
+def get_amp_dtype(mixed_precision, device_type):
+    """Map the mixed_precision option of train_model/evaluate_model to an
+    autocast dtype: None/False for fp32, 'bf16', 'fp16', or True/'auto' for
+    fp16 on cuda and bf16 on cpu."""
+    if not mixed_precision:
+        return None
+    if mixed_precision in [True, 'auto']:
+        mixed_precision = 'fp16' if device_type == 'cuda' else 'bf16'
+    assert mixed_precision in ['bf16', 'fp16']
+    return torch.bfloat16 if mixed_precision == 'bf16' else torch.float16
+
+
+def evaluate_model(model, dataloader, mixed_precision=None, channels_last=False):
+    """Mean IOU, pixel accuracy and images per second of model on dataloader,
+    optionally with autocast and channels_last as in train_model."""
+    device = next(model.parameters()).device
+    amp_dtype = get_amp_dtype(mixed_precision, device.type)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    model.eval()
+    metrics = IouAccumulator()
+    n_images = 0
+    start = time.time()
+    with torch.no_grad():
+        for X_batch, y_batch, d_batch, X_id in dataloader:
+            if channels_last:
+                X_batch = X_batch.contiguous(memory_format=torch.channels_last)
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                y_pred = model(X_batch)
+            metrics.update(y_pred.float().ge(0.5), y_batch.float())
+            n_images += len(X_batch)
+
+    return metrics.mean_iou(), metrics.accuracy(), n_images / (time.time() - start)
+
+
+def preprocess_images(np_img, mean_img, out_size=101, out_ch=1):
+    """Batched version of the SaltDataset preprocessing: subtract mean_img,
+    move channels first, reflect pad to out_size and repeat to out_ch.
+
+    Args:
+        np_img (ndarray): (B, H, W, C) images.
+    Returns:
+        Tensor: float (B, out_ch, out_size, out_size) images.
+    """
+    X = np.moveaxis(np.asarray(np_img) - mean_img, -1, 1).astype(np.float32)
+    pad_size = out_size - X.shape[2]
+    pad_first = pad_size//2
+    pad_last = pad_size - pad_first
+    X = np.pad(X, [(0, 0), (0, 0), (pad_first, pad_last), (pad_first, pad_last)], mode='reflect')
+
+    return torch.from_numpy(X).repeat(1, out_ch, 1, 1)
+
+
+def predict(model, np_img, img_ids, mean_img, out_file=None, prob_file=None, batch_size=64, flip_tta=False,
+            threshold=0.5, zero_mask_cut_off=0, out_size=101, out_ch=1, mixed_precision=None,
+            channels_last=False):
+    """Predict masks for np_img batch by batch.
+
+    Each batch is preprocessed, run through the model in inference mode,
+    thresholded and passed to adjust_predictions, then streamed out, so
+    memory does not grow with the number of images.
+
+    Args:
+        model (nn.Module): Trained SaltNet.
+        np_img (ndarray): (N, 101, 101, 1) raw images, can be memory-mapped.
+        img_ids (list): Id of every image, used for the rle csv.
+        mean_img (ndarray): Mean image used in training.
+        out_file (string, optional): Write the rle submission csv here.
+        prob_file (string, optional): Write the (N, 101, 101) float32
+            probabilities to this npy file.
+        flip_tta (bool): Average the predictions of the images and their
+            horizontal flips, run in the same forward batch.
+        threshold (float): Probability threshold of the masks.
+        zero_mask_cut_off (int): Passed to adjust_predictions.
+        mixed_precision, channels_last: As in evaluate_model.
+    Returns:
+        ndarray: uint8 (N, 101, 101) masks if out_file is None, else out_file.
+    """
+    device = next(model.parameters()).device
+    amp_dtype = get_amp_dtype(mixed_precision, device.type)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    model.eval()
+
+    n = len(np_img)
+    writer = None if out_file is None else RleCsvWriter(out_file, batch_size=batch_size)
+    masks = np.zeros((n, 101, 101), dtype=np.uint8) if out_file is None else None
+    probs = None
+    if prob_file is not None:
+        probs = np.lib.format.open_memmap(prob_file, mode='w+', dtype=np.float32, shape=(n, 101, 101))
+    try:
+        with torch.inference_mode():
+            for i in range(0, n, batch_size):
+                X_raw = np.asarray(np_img[i:i + batch_size])
+                X = preprocess_images(X_raw, mean_img, out_size, out_ch).to(device)
+                if flip_tta:
+                    X = torch.cat([X, X.flip(-1)])
+                if channels_last:
+                    X = X.contiguous(memory_format=torch.channels_last)
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    y_pred = model(X)
+                y_pred = y_pred.float().view(len(X), 101, 101)
+                if flip_tta:
+                    y_pred = (y_pred[:len(X_raw)] + y_pred[len(X_raw):].flip(-1)) / 2
+                y_pred = y_pred.cpu().numpy()
+                if probs is not None:
+                    probs[i:i + batch_size] = y_pred
+                y_mask = adjust_predictions(zero_mask_cut_off, X_raw, (y_pred >= threshold).astype(np.uint8))
+                if writer is not None:
+                    writer.write(img_ids[i:i + batch_size], y_mask)
+                else:
+                    masks[i:i + batch_size] = y_mask
+    finally:
+        if writer is not None:
+            writer.close()
+        if probs is not None:
+            probs.flush()
+
+    return masks if out_file is None else out_file
+
+
+def _window_starts(size, tile, stride):
+    # tile starts every stride pixels, the last one flush with the end
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] != size - tile:
+        starts.append(size - tile)
+    return starts
+
+
+def blend_window(tile=101, window='hann'):
+    """(tile, tile) weights of a tile when blending overlapping predictions:
+    'hann' or 'triangle' fade towards the tile edges, 'uniform' is a plain
+    average. Weights are > 0 everywhere so the section borders, covered by
+    a single tile, are still defined."""
+    assert window in ['hann', 'triangle', 'uniform']
+    if window == 'hann':
+        w = np.hanning(tile + 2)[1:-1]
+    elif window == 'triangle':
+        w = 1 - np.abs(np.linspace(-1, 1, tile + 2)[1:-1])
+    else:
+        w = np.ones(tile)
+
+    return np.outer(w, w).astype(np.float32)
+
+
+def predict_section(model, section, mean_img, out_file=None, stride=50, batch_size=64, window='hann',
+                    out_size=101, out_ch=1, mixed_precision=None, channels_last=False, verbose=True):
+    """Probability map of a seismic section larger than the 101x101 tiles
+    SaltNet is trained on, by sliding-window inference.
+
+    Overlapping windows are read from section in raster order and run
+    batch_size at a time, each batch may span several rows of windows. The
+    predictions are blended with blend_window weights in a buffer of only a
+    few tile heights, and every row of the map is written out as soon as no
+    later window covers it, so memory does not depend on the section size.
+
+    Args:
+        model (nn.Module): Trained SaltNet.
+        section (ndarray): (H, W) or (H, W, 1) raw section, H and W >= 101,
+            can be memory-mapped (np.load(..., mmap_mode='r')).
+        mean_img (ndarray): Mean image used in training.
+        out_file (string, optional): Write the (H, W) float32 map to this
+            npy file, memory-mapped while it is written. Without it the map
+            is returned in memory.
+        stride (int): Step between windows, at most 101.
+        window (string): Passed to blend_window.
+        mixed_precision, channels_last: As in evaluate_model.
+    Returns:
+        ndarray: float32 (H, W) probabilities, a memmap of out_file if given.
+    """
+    tile = 101
+    h, w = section.shape[:2]
+    if h < tile or w < tile:
+        raise ValueError('The section must be at least {0}x{0}, got {1}x{2}'.format(tile, h, w))
+    assert 0 < stride <= tile
+    device = next(model.parameters()).device
+    amp_dtype = get_amp_dtype(mixed_precision, device.type)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    model.eval()
+
+    ys, xs = _window_starts(h, tile, stride), _window_starts(w, tile, stride)
+    positions = [(y, x) for y in ys for x in xs]
+    weight = blend_window(tile, window)
+    # rows from buf_y0 on, enough for every window of one batch
+    buf_rows = min(h, tile + stride * (int(math.ceil(batch_size / len(xs))) + 1))
+    acc = np.zeros((buf_rows, w), dtype=np.float32)
+    wsum = np.zeros((buf_rows, w), dtype=np.float32)
+    buf_y0 = 0
+    if out_file is None:
+        out = np.empty((h, w), dtype=np.float32)
+    else:
+        out = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=(h, w))
+
+    start = time.time()
+    with torch.inference_mode():
+        for i in range(0, len(positions), batch_size):
+            batch = positions[i:i + batch_size]
+            X_raw = np.stack([np.asarray(section[y:y + tile, x:x + tile]).reshape(tile, tile, -1)
+                              for y, x in batch])
+            X = preprocess_images(X_raw, mean_img, out_size, out_ch).to(device)
+            if channels_last:
+                X = X.contiguous(memory_format=torch.channels_last)
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                y_pred = model(X)
+            y_pred = y_pred.float().view(len(X), tile, tile).cpu().numpy()
+            for (y, x), p in zip(batch, y_pred):
+                acc[y - buf_y0:y - buf_y0 + tile, x:x + tile] += p * weight
+                wsum[y - buf_y0:y - buf_y0 + tile, x:x + tile] += weight
+
+            # rows above the next window are final
+            next_y = positions[i + batch_size][0] if i + batch_size < len(positions) else h
+            done = next_y - buf_y0
+            if done > 0:
+                out[buf_y0:next_y] = acc[:done] / wsum[:done]
+                acc[:buf_rows - done] = acc[done:]
+                acc[buf_rows - done:] = 0
+                wsum[:buf_rows - done] = wsum[done:]
+                wsum[buf_rows - done:] = 0
+                buf_y0 = next_y
+            if verbose:
+                print(f'\r{min(i + batch_size, len(positions))}/{len(positions)} windows predicted', end='')
+    if verbose:
+        print('\n{:.1f} windows/s'.format(len(positions) / (time.time() - start)))
+    if out_file is not None:
+        out.flush()
+
+    return out
+
+
+class FoldedConvTranspose2d(nn.ConvTranspose2d):
+    """ConvTranspose2d with a BatchNorm in front of it folded in.
+
+    The BatchNorm scale goes into the weights. With stride == kernel_size
+    every output pixel gets exactly one kernel tap, so its shift adds a bias
+    per output channel and tap (tap_bias) that is tiled over the output.
+    """
+
+    def __init__(self, conv, scale, shift):
+        super().__init__(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                         padding=conv.padding, bias=True)
+        with torch.no_grad():
+            self.weight.copy_(conv.weight * scale[:, None, None, None])
+            self.bias.copy_(conv.bias if conv.bias is not None else torch.zeros_like(self.bias))
+        self.register_buffer('tap_bias', torch.einsum('iokl,i->okl', conv.weight.detach(), shift))
+
+    def forward(self, x):
+        out = super().forward(x)
+        h, w = x.shape[-2:]
+        p_h, p_w = self.padding
+        return out + self.tap_bias.repeat(1, h, w)[:, p_h:p_h + out.shape[-2], p_w:p_w + out.shape[-1]]
+
+
+def fold_batchnorm(seq, conv_transpose=True):
+    """Copy of the nn.Sequential seq with every eval-mode BatchNorm2d folded
+    into the conv after it.
+
+    A BatchNorm is folded into a Conv2d without padding (the zero padding of
+    the BatchNorm output can't be folded) and, if conv_transpose is True,
+    into a ConvTranspose2d with stride == kernel_size as a
+    FoldedConvTranspose2d. Other BatchNorms are kept.
+    """
+    layers = [copy.deepcopy(m).cpu().eval() for m in seq]
+    out = []
+    i = 0
+    while i < len(layers):
+        bn, conv = layers[i], layers[i + 1] if i + 1 < len(layers) else None
+        if not isinstance(bn, nn.BatchNorm2d) or not isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) \
+                or conv.groups != 1 or any(d != 1 for d in conv.dilation):
+            out.append(bn)
+            i += 1
+            continue
+        scale = (bn.weight / torch.sqrt(bn.running_var + bn.eps)).detach()
+        shift = (bn.bias - bn.running_mean * scale).detach()
+        if isinstance(conv, nn.ConvTranspose2d):
+            if not conv_transpose or tuple(conv.stride) != tuple(conv.kernel_size) or any(conv.output_padding):
+                out.append(bn)
+                i += 1
+                continue
+            out.append(FoldedConvTranspose2d(conv, scale, shift))
+        else:
+            if any(conv.padding) if not isinstance(conv.padding, str) else conv.padding != 'valid':
+                out.append(bn)
+                i += 1
+                continue
+            with torch.no_grad():
+                bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels)
+                bias = bias + conv.weight.sum((2, 3)) @ shift
+                conv.weight.mul_(scale[None, :, None, None])
+                conv.bias = nn.Parameter(bias)
+            out.append(conv)
+        i += 2
+
+    return nn.Sequential(*out).eval()
+
+
+class SaltNetInference(nn.Module):
+    """SaltNet.forward around an optimized copy of SaltNet.seq."""
+
+    def __init__(self, seq):
+        super().__init__()
+        self.seq = seq
+
+    def forward(self, X):
+        out = self.seq(X)
+        return torch.clamp(out[:,:,:-1,:-1].squeeze(), 0.0, 1.0)
+
+
+def _freeze_inference_module(net, example_input, out_file=None):
+    # traced rather than scripted, quantized BatchNorm can't be scripted
+    with torch.no_grad():
+        module = torch.jit.freeze(torch.jit.trace(net.eval(), example_input))
+    if out_file is not None:
+        torch.jit.save(module, out_file)
+
+    return module
+
+
+def export_saltnet(model, out_file=None, fold_bn=True, example_input=None):
+    """Frozen TorchScript SaltNet for CPU inference with the BatchNorms
+    folded into the convs (see fold_batchnorm).
+
+    Args:
+        out_file (string, optional): Also save the module with torch.jit.save,
+            load it with torch.jit.load.
+        example_input (Tensor): Input used for tracing, defaults to two
+            101x101 images.
+    Returns:
+        ScriptModule: same outputs as model.eval().
+    """
+    seq = fold_batchnorm(model.seq) if fold_bn else copy.deepcopy(model.seq).cpu()
+    if example_input is None:
+        example_input = torch.zeros(2, 1, 101, 101)
+
+    return _freeze_inference_module(SaltNetInference(seq), example_input, out_file)
+
+
+def quantize_saltnet(model, dataset, n_calibration=256, batch_size=32, backend=None, seed=0, out_file=None):
+    """Post-training static int8 quantization of SaltNet for CPU.
+
+    The BatchNorms are folded as in export_saltnet. The encoder (everything
+    before the first transposed conv, where nearly all of the compute is)
+    runs in int8; the transposed convs stay fp32 since the fbgemm/x86
+    quantized ConvTranspose2d kernels give wrong results. Activation ranges
+    are calibrated on n_calibration random items of dataset (a SaltDataset).
+
+    Args:
+        backend (string): Quantized engine, defaults to 'fbgemm' ('x86'
+            mishandles the padding of the first conv), or 'qnnpack' where
+            fbgemm is not available.
+        out_file (string, optional): Also save the module with torch.jit.save.
+    Returns:
+        ScriptModule: frozen model, taking and returning float tensors.
+    """
+    from torch.ao import quantization
+    engines = torch.backends.quantized.supported_engines
+    backend = backend or ('fbgemm' if 'fbgemm' in engines else 'qnnpack')
+    torch.backends.quantized.engine = backend
+
+    folded = list(fold_batchnorm(model.seq))
+    n_int8 = next(k for k, m in enumerate(folded) if isinstance(m, nn.ConvTranspose2d))
+    encoder = nn.Sequential(quantization.QuantStub(), *folded[:n_int8], quantization.DeQuantStub())
+    encoder.qconfig = quantization.get_default_qconfig(backend)
+    net = SaltNetInference(nn.Sequential(encoder, *folded[n_int8:])).eval()
+    prepared = quantization.prepare(net)
+
+    idx = np.random.RandomState(seed).choice(len(dataset), min(n_calibration, len(dataset)), replace=False)
+    loader = DataLoader(dataset, batch_size=batch_size, sampler=idx.tolist())
+    with torch.no_grad():
+        for X_batch, *_ in loader:
+            prepared(X_batch.float().cpu())
+    quantized = quantization.convert(prepared)
+
+    return _freeze_inference_module(quantized, X_batch.float().cpu()[:2], out_file)
+
+
+def compare_inference(models, dataset, n_images=512, batch_size=32, repeat=3, seed=0):
+    """CPU latency and accuracy of inference models against the first one.
+
+    Args:
+        models (dict): name -> model, e.g. {'fp32': model, 'folded':
+            export_saltnet(model), 'int8': quantize_saltnet(model, ds)}.
+            The first model is the reference.
+        dataset (SaltDataset): n_images random items are predicted.
+        repeat (int): Passes over the images, the fastest is reported.
+    Returns:
+        DataFrame: per model ms per image, images/s, mean IOU and pixel
+            accuracy against the labels, and against the reference the IOU
+            difference, the max abs difference of the probabilities and the
+            fraction of mask pixels that agree.
+    """
+    idx = np.random.RandomState(seed).choice(len(dataset), min(n_images, len(dataset)), replace=False)
+    batches = [(X.float().cpu(), y.float().cpu())
+               for X, y, *_ in DataLoader(dataset, batch_size=batch_size, sampler=idx.tolist())]
+    results = []
+    reference = None
+    for name, model in models.items():
+        if isinstance(model, nn.Module):
+            model = copy.deepcopy(model).cpu().eval()
+        metrics = IouAccumulator()
+        times = []
+        with torch.no_grad():
+            for k in range(repeat):
+                probs = []
+                start = time.perf_counter()
+                for X_batch, _ in batches:
+                    probs.append(model(X_batch).reshape(-1, 101, 101))
+                times.append(time.perf_counter() - start)
+        probs = torch.cat(probs)
+        for (_, y_batch), p in zip(batches, probs.split(batch_size)):
+            metrics.update(p.ge(0.5), y_batch.reshape(-1, 101, 101))
+        if reference is None:
+            reference = probs
+        results.append({'model': name, 'ms_per_image': 1000 * min(times) / len(probs),
+                        'img_per_sec': len(probs) / min(times), 'mean_iou': metrics.mean_iou(),
+                        'accuracy': metrics.accuracy(),
+                        'iou_diff': metrics.mean_iou() - results[0]['mean_iou'] if results else 0.,
+                        'max_abs_diff': (probs - reference).abs().max().item(),
+                        'mask_agreement': (probs.ge(0.5) == reference.ge(0.5)).float().mean().item()})
+
+    import pandas as pd
+    results = pd.DataFrame(results).set_index('model')
+    print(results)
+
+    return results
+
+
+class SaltNetEnsemble(nn.Module):
+    """K SaltNets of the same architecture run as one network.
+
+    The layers of the members are stacked: the first conv gets K times the
+    output channels, the later convs and transposed convs become grouped
+    convs with groups=K and the BatchNorms are concatenated, so a single
+    forward pass computes all K outputs. Only for inference, call eval().
+
+    Args:
+        models (list): SaltNet models, or their state_dicts.
+        combine (string): 'mean' averages the K probabilities, 'vote' returns
+            the fraction of members predicting foreground (> 0.5 is a
+            majority), 'none' returns all K as (B, K, 101, 101).
+    """
+
+    def __init__(self, models, combine='mean'):
+        super().__init__()
+        assert combine in ['mean', 'vote', 'none']
+        nets = []
+        for m in models:
+            if not isinstance(m, nn.Module):
+                net = SaltNet()
+                net.load_state_dict(m)
+                m = net
+            nets.append(m)
+        self.n_models = len(nets)
+        self.combine = combine
+        self.seq = nn.Sequential(*[self._stack_layers([net.seq[i] for net in nets], first=(i == 0))
+                                   for i in range(len(nets[0].seq))])
+        self.eval()
+
+    def _stack_layers(self, layers, first=False):
+        k = len(layers)
+        layer = layers[0]
+        if isinstance(layer, (nn.Conv2d, nn.ConvTranspose2d)):
+            # the input of the first conv is shared, later ones see the K groups of channels
+            if layer.groups != 1 or (first and isinstance(layer, nn.ConvTranspose2d)):
+                raise ValueError('Layer {} is not supported by SaltNetEnsemble'.format(layer))
+            kwargs = dict(stride=layer.stride, padding=layer.padding, dilation=layer.dilation,
+                          groups=1 if first else k, bias=layer.bias is not None)
+            in_channels = layer.in_channels if first else k * layer.in_channels
+            if isinstance(layer, nn.ConvTranspose2d):
+                stacked = nn.ConvTranspose2d(in_channels, k * layer.out_channels, layer.kernel_size,
+                                             output_padding=layer.output_padding, **kwargs)
+            else:
+                stacked = nn.Conv2d(in_channels, k * layer.out_channels, layer.kernel_size, **kwargs)
+            # Conv2d weights are (out, in/groups, kh, kw), ConvTranspose2d (in, out/groups, kh, kw):
+            # concatenating the members on dim 0 gives the grouped layout in both cases
+            with torch.no_grad():
+                stacked.weight.copy_(torch.cat([l.weight for l in layers]))
+                if layer.bias is not None:
+                    stacked.bias.copy_(torch.cat([l.bias for l in layers]))
+            return stacked
+        if isinstance(layer, nn.BatchNorm2d):
+            stacked = nn.BatchNorm2d(k * layer.num_features, eps=layer.eps, momentum=layer.momentum,
+                                     affine=layer.affine)
+            with torch.no_grad():
+                for name in ['weight', 'bias', 'running_mean', 'running_var']:
+                    if getattr(layer, name) is not None:
+                        getattr(stacked, name).copy_(torch.cat([getattr(l, name) for l in layers]))
+            return stacked
+        if isinstance(layer, (nn.MaxPool2d, nn.ReLU, nn.Sigmoid)):
+            # no parameters, applied per channel
+            return copy.deepcopy(layer)
+        raise ValueError('Layer {} is not supported by SaltNetEnsemble'.format(layer))
+
+    @classmethod
+    def from_checkpoints(cls, out_file_prefixes, outputFolder='.', combine='mean', verify=True):
+        """Ensemble of the checkpoints saved by train_model, e.g. the
+        checkpoint column of cross_validate."""
+        states = [load_model_state_from_chunks(prefix, outputFolder, map_location='cpu', keys=['model'],
+                                               verify=verify)['model']
+                  for prefix in out_file_prefixes]
+        return cls(states, combine=combine)
+
+    def forward(self, X):
+        out = self.seq(X)
+        out = torch.clamp(out[:,:,:-1,:-1], 0.0, 1.0)
+        if self.combine == 'mean':
+            out = out.mean(1)
+        elif self.combine == 'vote':
+            out = out.gt(0.5).float().mean(1)
+        return out.squeeze()
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+class ShardSampler(Sampler):
+    """Every world_size-th index starting at rank, without the padding of
+    DistributedSampler, so each item is seen exactly once over all ranks.
+    Used for validation where metrics must match a single process."""
+
+    def __init__(self, dataset, rank=None, world_size=None):
+        self.dataset = dataset
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.world_size))
+
+
+def get_distributed_dataloaders(datasets, batch_size, **kwargs):
+    """DataLoaders for {'train': SaltDataset, 'val': SaltDataset} that split
+    the data over the ranks: a shuffling DistributedSampler for train and a
+    ShardSampler for val."""
+    return {'train': DataLoader(datasets['train'], batch_size=batch_size,
+                                sampler=DistributedSampler(datasets['train'], shuffle=True), **kwargs),
+            'val': DataLoader(datasets['val'], batch_size=batch_size,
+                              sampler=ShardSampler(datasets['val']), **kwargs)}
 
-    return split_file_save(output, out_file_prefix, outputFolder, chunkSize=chunk_size)
+
+def _distributed_worker(rank, fn, world_size, backend, master_addr, master_port, args, kwargs):
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = str(master_port)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    try:
+        fn(*args, **kwargs)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch_distributed(fn, world_size, args=(), kwargs=None, backend='gloo', master_addr='127.0.0.1',
+                       master_port=29500):
+    """Run fn(*args, **kwargs) in world_size local processes with the default
+    process group initialized, e.g. a function that builds the dataloaders
+    with get_distributed_dataloaders and calls train_model(distributed=True).
+    For several nodes start the processes with torchrun instead and call
+    dist.init_process_group('gloo') before train_model."""
+    mp.spawn(_distributed_worker, args=(fn, world_size, backend, master_addr, master_port, args, kwargs or {}),
+             nprocs=world_size, join=True)
+
+
+class TrainingProfiler(object):
+    """Per-stage timings and throughput of the train_model phases.
+
+    Stage times are summed per phase and written to the logger and, if
+    jsonl_file is given, as one json line per phase. A window of training
+    iterations can also be recorded with torch.profiler. When disabled,
+    stage() and iterate() add no work to the loop.
+
+    Args:
+        enabled (bool): Record timings.
+        jsonl_file (string, optional): Append the phase summaries here.
+        profile_window (tuple, optional): (first iteration, number of
+            iterations) of the training loop to run under torch.profiler.
+        trace_dir (string): Folder for the torch.profiler chrome traces.
+        sync_cuda (bool): Synchronize cuda at the end of every stage so the
+            times are not hidden by asynchronous kernels.
+    """
+    _null_stage = contextlib.nullcontext()
+
+    def __init__(self, enabled=True, jsonl_file=None, profile_window=None, trace_dir='.', sync_cuda=True):
+        self.enabled = enabled
+        self.jsonl_file = jsonl_file
+        self.profile_window = profile_window
+        self.trace_dir = trace_dir
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.torch_profiler = None
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.iters = 0
+        self.phase_start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            self.stages[name] = self.stages.get(name, 0.) + time.perf_counter() - t
+
+    def stage(self, name):
+        """Context manager adding the time spent in it to stage name."""
+        if not self.enabled:
+            return self._null_stage
+        return self._timed(name)
+
+    def iterate(self, dataloader):
+        """Iterate over dataloader, timing the wait for every batch as 'data'."""
+        if not self.enabled:
+            return iter(dataloader)
+        return self._iterate(dataloader)
+
+    def _iterate(self, dataloader):
+        it = iter(dataloader)
+        while True:
+            with self._timed('data'):
+                try:
+                    batch = next(it)
+                except StopIteration:
+                    return
+            self.iters += 1
+            yield batch
+
+    def start(self):
+        if self.profile_window is not None:
+            first, n = self.profile_window
+            self.torch_profiler = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU] +
+                           ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else []),
+                schedule=torch.profiler.schedule(wait=max(first - 1, 0), warmup=min(first, 1), active=n, repeat=1),
+                on_trace_ready=self._save_trace, record_shapes=True)
+            self.torch_profiler.start()
+
+    def _save_trace(self, prof):
+        trace_file = os.path.join(self.trace_dir, f'trace_{get_current_time_as_fname()}.json')
+        prof.export_chrome_trace(trace_file)
+        self.trace_summary = prof.key_averages().table(sort_by='self_cpu_time_total', row_limit=15)
+        self.trace_file = trace_file
+
+    def step(self):
+        """Call once per training iteration."""
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def stop(self, log=None):
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+            if log is not None and hasattr(self, 'trace_file'):
+                log.info('torch.profiler trace saved to {}\n{}'.format(self.trace_file, self.trace_summary))
+
+    def end_phase(self, epoch, phase, samples, log=None):
+        """Log and save the summary of the phase and reset the counters."""
+        if not self.enabled:
+            return None
+        wall_time = time.perf_counter() - self.phase_start
+        summary = {'time': get_current_time_as_fname(), 'epoch': epoch, 'phase': phase,
+                   'iters': self.iters, 'samples': samples, 'wall_time': wall_time,
+                   'samples_per_sec': samples / wall_time if wall_time > 0 else None,
+                   'stages': self.stages,
+                   'other': wall_time - sum(self.stages.values())}
+        if log is not None:
+            log.info('{} {:.1f} samples/s, stages: {}'.format(
+                phase, summary['samples_per_sec'] or 0,
+                ', '.join('{} {:.2f}s ({:.0%})'.format(k, v, v / wall_time)
+                          for k, v in sorted(self.stages.items(), key=lambda e: -e[1]))))
+        if self.jsonl_file is not None:
+            with open(self.jsonl_file, 'a') as f:
+                f.write(json.dumps(summary) + '\n')
+        self.reset()
+        return summary
 
 
 def train_model(model, dataloaders, criterion, optimizer, scheduler, model_save_name, other_data={},
-                num_epochs=25, print_every=2, save_model_every=None, save_log_every=None, log=get_logger('SaltNet')):
+                num_epochs=25, print_every=2, save_model_every=None, save_log_every=None, log=None,
+                batch_transform=None, mixed_precision=None, channels_last=False, profiler=None, plot_sink=None,
+                distributed=False, accumulation_steps=1):
+    # with distributed=True only rank 0 logs, plots and saves checkpoints
+    is_main = not distributed or is_main_process()
+    if log is None:
+        log = get_logger('SaltNet') if is_main else logging.getLogger('SaltNet')
+    if not is_main:
+        log = logging.getLogger('{}.rank{}'.format(log.name, get_rank()))
+        log.disabled = True
+        profiler = TrainingProfiler(enabled=False)
+        plot_sink = PlotSink('off')
     #args = locals()
     #args = {k:v.shape if isinstance(v, (torch.Tensor, np.ndarray)) else v for k,v in args.items()}
     #args = {k:v.shape if isinstance(v, (torch.Tensor, np.ndarray)) else v for k,v in args.items()}
@@ -535,9 +2475,23 @@ def train_model(model, dataloaders, criterion, optimizer, scheduler, model_save_
 
     if torch.cuda.is_available():
         model.cuda()
-
-    best_model_wts = copy.deepcopy(model.state_dict())
+    device = next(model.parameters()).device
+    # autocast for forward passes, loss and metrics stay in fp32
+    amp_dtype = get_amp_dtype(mixed_precision, device.type)
+    scaler = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    log.info('Mixed precision: {}, channels_last: {}'.format(amp_dtype, channels_last))
+    net = model
+    if distributed:
+        if not isinstance(model, DistributedDataParallel):
+            model = DistributedDataParallel(model)
+        net = model.module
+        log.info('Distributed training on {} processes'.format(get_world_size()))
+
+    best_model_wts = copy.deepcopy(net.state_dict())
     best_model = None
+    checkpoint_writer = AsyncCheckpointWriter(log=log)
     best_iou = 0.0
     all_losses = []
     iter_count = 0
@@ -546,12 +2500,17 @@ def train_model(model, dataloaders, criterion, optimizer, scheduler, model_save_
     y_train = other_data['y_train']
     y_val = other_data['y_val']
     X_train_mean_img = other_data['X_train_mean_img']
+    if profiler is None:
+        profiler = TrainingProfiler(enabled=False)
+    profiler.start()
+    if plot_sink is None:
+        plot_sink = PlotSink('inline')
 
     for epoch in range(1, num_epochs+1):
         log.info('Epoch {}/{}'.format(epoch, num_epochs))
         log.info('-' * 20)
         if save_log_every is not None:
-            if (epoch % save_log_every == 0):
+            if (epoch % save_log_every == 0) and is_main:
                 push_log_to_git()
         # Each epoch has a training and validation phase
         for phase in ['train', 'val']:
@@ -562,90 +2521,387 @@ def train_model(model, dataloaders, criterion, optimizer, scheduler, model_save_
                 model.eval()   # Set model to evaluate mode
 
             epoch_loss = []
-            pred_vs_true_epoch = []
-
-            for X_batch, y_batch, d_batch, X_id in dataloaders[phase]:
+            metrics_epoch = IouAccumulator()
+            phase_start = time.time()
+            phase_images = 0
+            profiler.reset()
+            if hasattr(dataloaders[phase].sampler, 'set_epoch'):
+                dataloaders[phase].sampler.set_epoch(epoch)
+
+            n_batches = len(dataloaders[phase])
+            # the IOU takes the bool fast path only for targets that are exactly 0/1
+            binary_targets = getattr(dataloaders[phase].dataset, 'binary_masks', False) \
+                and not ((phase == 'train') and (batch_transform is not None))
+            optimizer.zero_grad()
+            for batch_idx, (X_batch, y_batch, d_batch, X_id) in enumerate(profiler.iterate(dataloaders[phase])):
+                if (phase == 'train') and (batch_transform is not None):
+                    # batched augmentation, e.g. BatchRescaleCropFlip
+                    with profiler.stage('transform'):
+                        X_batch, y_batch = batch_transform(X_batch, y_batch)
                 #print(X_batch.shape)
                 #print(len(iter(dataloaders[phase])))
-                # zero the parameter gradients
-                optimizer.zero_grad()
+                if channels_last:
+                    X_batch = X_batch.contiguous(memory_format=torch.channels_last)
+                phase_images += len(X_batch)
                 with torch.set_grad_enabled(phase == 'train'):
-                    y_pred = model(X_batch)
-                    pred_vs_true_epoch.append([y_pred, y_batch])
-                    #from boxx import g
-                    #g()
-                    loss = criterion(y_pred, y_batch.float())
-                    all_losses.append(loss.item())
-                    epoch_loss.append(loss.item())
-
-                    # backward + optimize only if in training phase
+                    with profiler.stage('forward'):
+                        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                            y_pred = model(X_batch)
+                        y_pred = y_pred.float()
+                        #from boxx import g
+                        #g()
+                        loss = criterion(y_pred, y_batch.float())
+                    with profiler.stage('metrics'):
+                        y_metric = y_batch.ge(0.5) if binary_targets else y_batch.float()
+                        metrics_epoch.update(y_pred.ge(0.5), y_metric)
+                        all_losses.append(loss.item())
+                        epoch_loss.append(all_losses[-1])
+
+                    # backward + optimize only if in training phase, gradients are
+                    # accumulated over accumulation_steps batches per optimizer step
                     if phase == 'train':
-                        loss.backward()
-                        optimizer.step()
+                        step_now = ((batch_idx + 1) % accumulation_steps == 0) or (batch_idx + 1 == n_batches)
+                        # the last group of the epoch can have fewer batches
+                        group_start = batch_idx - batch_idx % accumulation_steps
+                        group_size = min(accumulation_steps, n_batches - group_start)
+                        with profiler.stage('backward'):
+                            # no gradient all-reduce for the batches in between
+                            with model.no_sync() if distributed and not step_now else contextlib.nullcontext():
+                                scaler.scale(loss / group_size).backward()
+                            if step_now:
+                                scaler.step(optimizer)
+                                scaler.update()
+                                # zero the parameter gradients
+                                optimizer.zero_grad()
                         iter_count += 1
+                        profiler.step()
                 if (phase == 'train') & (iter_count % print_every == 0):
-                    iou_batch = calc_mean_iou(y_pred.ge(0.5), y_batch.float())
-                    iou_acc = calc_clf_accuracy(y_pred.ge(0.5), y_batch.float())
-
-                    log.info('Batch Loss: {:.4f}, Epoch loss: {:.4f}, Batch IOU: {:.4f}, Batch Acc: {:.4f} at iter {}, epoch {}, Time: {}'.format(
-                        np.mean(all_losses[-print_every:]), np.mean(epoch_loss), iou_batch, iou_acc, iter_count, epoch, timeSince(start))
-                    )
-                    X_orig = X_train[X_id[0]].squeeze()
-                    X_tsfm = X_batch[0,0].squeeze().cpu().detach().numpy()
-                    X_tsfm = transform.resize(X_tsfm, (128, 128), mode='constant', preserve_range=True)
-                    X_tsfm = X_tsfm[13:114,13:114] + X_train_mean_img.squeeze()
-                    #X_tsfm = X_batch[0][X_batch[0].sum((1,2)).argmax()].squeeze().cpu().detach().numpy()[:101,:101] + X_train_mean_img.squeeze()
-
-                    y_orig = y_train[X_id[0]].squeeze()
-                    y_tsfm = (y_batch[0].squeeze().cpu().detach().numpy())
-                    y_tsfm_pred =  y_pred[0].squeeze().gt(0.5)
-                    plot_img_mask_pred([X_orig, X_tsfm, y_orig, y_tsfm, y_tsfm_pred],
-                                       ['X Original', 'X Transformed', 'y Original', 'y Transformed', 'y Predicted'])
-
-            y_pred_epoch = torch.cat([e[0] for e in pred_vs_true_epoch])
-            y_true_epoch = torch.cat([e[1] for e in pred_vs_true_epoch])
-            #from boxx import g
-            #g()
-            mean_iou_epoch = calc_mean_iou(y_pred_epoch.ge(0.5), y_true_epoch.float())
-            mean_acc_epoch = calc_clf_accuracy(y_pred_epoch.ge(0.5), y_true_epoch.float())
-            log.info('{} Mean IOU: {:.4f}, Mean Acc: {:.4f}, Best Val IOU: {:.4f} at epoch {}'.format(phase, mean_iou_epoch, mean_acc_epoch, best_iou, epoch))
+                    with profiler.stage('plot'):
+                        iou_batch = calc_mean_iou(y_pred.ge(0.5), y_batch.float())
+                        iou_acc = calc_clf_accuracy(y_pred.ge(0.5), y_batch.float())
+
+                        log.info('Batch Loss: {:.4f}, Epoch loss: {:.4f}, Batch IOU: {:.4f}, Batch Acc: {:.4f} at iter {}, epoch {}, Time: {}'.format(
+                            np.mean(all_losses[-print_every:]), np.mean(epoch_loss), iou_batch, iou_acc, iter_count, epoch, timeSince(start))
+                        )
+                        if plot_sink.enabled:
+                            X_orig = X_train[X_id[0]].squeeze()
+                            # centre 101x101 of the padded input, no resize needed
+                            pad = (X_batch.shape[-1] - 101)//2
+                            X_tsfm = X_batch[0,0,pad:pad+101,pad:pad+101].cpu().numpy() + X_train_mean_img.squeeze()
+                            #X_tsfm = X_batch[0][X_batch[0].sum((1,2)).argmax()].squeeze().cpu().detach().numpy()[:101,:101] + X_train_mean_img.squeeze()
+
+                            y_orig = y_train[X_id[0]].squeeze()
+                            y_tsfm = y_batch[0].squeeze()
+                            y_tsfm_pred =  y_pred[0].squeeze().gt(0.5)
+                            plot_sink.plot([X_orig, X_tsfm, y_orig, y_tsfm, y_tsfm_pred],
+                                           ['X Original', 'X Transformed', 'y Original', 'y Transformed', 'y Predicted'],
+                                           name='train')
+
+            with profiler.stage('metrics'):
+                if distributed:
+                    metrics_epoch.all_reduce()
+                mean_iou_epoch = metrics_epoch.mean_iou()
+                mean_acc_epoch = metrics_epoch.accuracy()
+            log.info('{} Mean IOU: {:.4f}, Mean Acc: {:.4f}, Best Val IOU: {:.4f} at epoch {}, {:.1f} img/s'.format(
+                phase, mean_iou_epoch, mean_acc_epoch, best_iou, epoch, phase_images / (time.time() - phase_start)))
             if phase == 'val' and mean_iou_epoch > best_iou:
                 best_iou = mean_iou_epoch
-                best_model_wts = copy.deepcopy(model.state_dict())
                 stats = {'best_iou': best_iou,
                          'all_losses': all_losses,
                          'iter_count': iter_count}
-                log.info(save_model_state_to_chunks(epoch, copy.deepcopy(model.state_dict()),
-                                                    copy.deepcopy(optimizer.state_dict()),
-                                                    copy.deepcopy(scheduler.state_dict()), stats, model_save_name, '.'))
-                best_model = (epoch, copy.deepcopy(model.state_dict()),
-                                                    copy.deepcopy(optimizer.state_dict()),
-                                                    copy.deepcopy(scheduler.state_dict()), stats, model_save_name, '.')
+                # states are snapshotted to CPU once and written in the background
+                with profiler.stage('checkpoint'):
+                    if is_main:
+                        best_model = checkpoint_writer.save(epoch, net.state_dict(), optimizer.state_dict(),
+                                                            scheduler.state_dict(), stats, model_save_name, '.')
+                        best_model_wts = best_model[1]
+                    else:
+                        best_model_wts = snapshot_state(net.state_dict())
                 log.info('Best Val Mean IOU so far: {}'.format(best_iou))
                 # Visualize 1 val sample and predictions
                 X_orig = X_val[X_id[0]].squeeze()
                 y_orig = y_val[X_id[0]].squeeze()
                 y_pred2 =  y_pred[0].squeeze().gt(0.5)
-                plot_img_mask_pred([X_orig, y_orig, y_pred2],
-                                   ['Val X Original', 'Val y Original', 'Val y Predicted'])
-        if save_model_every is not None:
+                with profiler.stage('plot'):
+                    plot_sink.plot([X_orig, y_orig, y_pred2],
+                                   ['Val X Original', 'Val y Original', 'Val y Predicted'], name='val')
+            profiler.end_phase(epoch, phase, phase_images, log)
+        if save_model_every is not None and is_main:
             if (epoch % save_model_every == 0) | (epoch == num_epochs-1):
                 if best_model is not None:
-                    log.info(save_model_state_to_chunks(*best_model))
+                    # the best checkpoint must be on disk before pushing it
+                    checkpoint_writer.wait()
                     push_model_to_git(ckp_name=model_save_name)
                     best_model = None
                 else:
                     log.info("Skip pushing model to git as there's no improvement")
 
+    profiler.stop(log)
+    plot_sink.close()
+    checkpoint_writer.close()
     # load best model weights
-    model.load_state_dict(best_model_wts)
+    net.load_state_dict(best_model_wts)
     log.info('-' * 20)
     time_elapsed = time.time() - start
     log.info('Training complete in {:.0f}m {:.0f}s'.format(
         time_elapsed // 60, time_elapsed % 60))
     log.info('Best val IOU: {:4f}'.format(best_iou))
 
-    return model
+    return net
+
+
+def _time_train_steps(model, optimizer, criterion, batches, device, batch_transform=None, mixed_precision=None,
+                      channels_last=False, warmup=2):
+    # samples per second of forward/backward/step over batches, skipping warmup
+    amp_dtype = get_amp_dtype(mixed_precision, device.type)
+    model.train()
+    samples = 0
+    for k, (X_batch, y_batch) in enumerate(batches):
+        if k == warmup:
+            start = time.perf_counter()
+            samples = 0
+        X_batch, y_batch = X_batch.to(device), y_batch.to(device)
+        if batch_transform is not None:
+            X_batch, y_batch = batch_transform(X_batch, y_batch)
+        if channels_last:
+            X_batch = X_batch.contiguous(memory_format=torch.channels_last)
+        optimizer.zero_grad()
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            y_pred = model(X_batch)
+        criterion(y_pred.float(), y_batch.float()).backward()
+        optimizer.step()
+        samples += len(X_batch)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+    return samples / (time.perf_counter() - start)
+
+
+def tune_dataloader(dataset, model, criterion, batch_sizes=(8, 16, 32, 64, 128), num_workers=(0, 1, 2, 4, 8),
+                    target_batch_size=None, n_batches=8, warmup=2, batch_transform=None, mixed_precision=None,
+                    channels_last=False, optimizer_cls=torch.optim.Adam):
+    """Pick the micro batch size and DataLoader num_workers with the best
+    training throughput by timing a few steps of the real pipeline.
+
+    The trials run on a copy of model with its own optimizer, so model is not
+    changed. Batch sizes are timed first on pre-loaded batches (a batch size
+    that runs out of memory ends the search), then the worker counts with the
+    best batch size through a DataLoader. If target_batch_size is given, only
+    batch sizes up to it are tried and accumulation_steps is set so that
+    batch_size * accumulation_steps >= target_batch_size, to be passed to
+    train_model.
+
+    Returns:
+        dict: batch_size, num_workers, accumulation_steps and a DataFrame of
+            all trials.
+    """
+    device = next(model.parameters()).device
+    trial_model = copy.deepcopy(model)
+    if channels_last:
+        trial_model.to(memory_format=torch.channels_last)
+    optimizer = optimizer_cls(trial_model.parameters())
+    if target_batch_size is not None:
+        batch_sizes = [b for b in batch_sizes if b <= target_batch_size] or [target_batch_size]
+    results = []
+
+    for batch_size in sorted(batch_sizes):
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0, drop_last=True)
+        batches = [(b[0], b[1]) for b, _ in zip(loader, range(n_batches + warmup))]
+        if len(batches) <= warmup:
+            break
+        try:
+            speed = _time_train_steps(trial_model, optimizer, criterion, batches, device, batch_transform,
+                                      mixed_precision, channels_last, warmup)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            print(f'batch_size {batch_size}: out of memory')
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+            break
+        print(f'batch_size {batch_size}: {speed:.1f} samples/s')
+        results.append({'trial': 'batch_size', 'batch_size': batch_size, 'num_workers': 0, 'samples_per_sec': speed})
+    if not results:
+        raise RuntimeError('None of the batch sizes {} could be timed'.format(list(batch_sizes)))
+    best_batch_size = max(results, key=lambda r: r['samples_per_sec'])['batch_size']
+
+    for workers in num_workers:
+        loader = DataLoader(dataset, batch_size=best_batch_size, shuffle=True, num_workers=workers, drop_last=True)
+        batches = ((b[0], b[1]) for b, _ in zip(loader, range(n_batches + warmup)))
+        speed = _time_train_steps(trial_model, optimizer, criterion, batches, device, batch_transform,
+                                  mixed_precision, channels_last, warmup)
+        print(f'batch_size {best_batch_size}, num_workers {workers}: {speed:.1f} samples/s')
+        results.append({'trial': 'num_workers', 'batch_size': best_batch_size, 'num_workers': workers,
+                        'samples_per_sec': speed})
+    worker_results = [r for r in results if r['trial'] == 'num_workers'] or results
+    best_workers = max(worker_results, key=lambda r: r['samples_per_sec'])['num_workers']
+
+    accumulation_steps = 1
+    if target_batch_size is not None:
+        accumulation_steps = int(math.ceil(target_batch_size / best_batch_size))
+
+    import pandas as pd
+    return {'batch_size': best_batch_size, 'num_workers': best_workers, 'accumulation_steps': accumulation_steps,
+            'results': pd.DataFrame(results)}
+
+
+def mask_coverage(masks, chunk_size=4096):
+    """Fraction of foreground pixels of every mask, masks as PackedMasks or
+    an (N, H, W[, 1]) array."""
+    if isinstance(masks, PackedMasks):
+        size = masks.mask_shape[0] * masks.mask_shape[1]
+        counts = np.concatenate([popcount(np.asarray(masks.packed[i:i + chunk_size])).sum(1, dtype=np.int64)
+                                 for i in range(0, len(masks), chunk_size)] or [np.empty(0)])
+        return counts / size
+    masks = np.asarray(masks)
+    return (masks.reshape(len(masks), -1) > 0).mean(1)
+
+
+def make_stratified_folds(df_depth, masks=None, n_folds=5, by='coverage', n_bins=10, seed=0):
+    """Assign every image to one of n_folds folds, stratified by mask coverage
+    or depth.
+
+    by='coverage' puts the empty masks in one stratum and splits the others
+    into n_bins coverage quantiles, by='depth' uses n_bins quantiles of the
+    first column of df_depth. Each stratum is shuffled and dealt over the
+    folds in turn, so fold sizes differ by at most one.
+
+    Returns:
+        ndarray: int fold number of every image, in the order of df_depth.
+    """
+    assert by in ['coverage', 'depth']
+    if by == 'coverage':
+        values = mask_coverage(masks)
+        edges = np.quantile(values[values > 0], np.linspace(0, 1, n_bins + 1)[1:-1]) if (values > 0).any() else []
+        strata = np.where(values > 0, np.digitize(values, edges) + 1, 0)
+    else:
+        values = df_depth.iloc[:, 0].values
+        strata = np.digitize(values, np.quantile(values, np.linspace(0, 1, n_bins + 1)[1:-1]))
+
+    rng = np.random.RandomState(seed)
+    folds = np.empty(len(strata), dtype=np.int64)
+    offset = 0
+    for stratum in np.unique(strata):
+        members = rng.permutation(np.nonzero(strata == stratum)[0])
+        folds[members] = (offset + np.arange(len(members))) % n_folds
+        offset += len(members)
+
+    return folds
+
+
+def fold_mean_images(np_img, folds, n_folds, chunk_size=1000):
+    """Mean image of the training part (all other folds) of every fold, from
+    a single pass over np_img. Returns (n_folds,) + np_img.shape[1:]."""
+    fold_sums = np.zeros((n_folds,) + tuple(np_img.shape[1:]), dtype=np.float64)
+    for i in range(0, len(np_img), chunk_size):
+        np.add.at(fold_sums, folds[i:i + chunk_size], np.asarray(np_img[i:i + chunk_size], dtype=np.float64))
+    fold_counts = np.bincount(folds, minlength=n_folds)
+    train_counts = (len(folds) - fold_counts).reshape((n_folds,) + (1,) * (np_img.ndim - 1))
+
+    return (fold_sums.sum(0) - fold_sums) / train_counts
+
+
+def _limit_threads(n_threads):
+    # initializer of the cross_validate worker processes
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(n_threads)
+    torch.set_num_threads(n_threads)
+    try:
+        torch.set_num_interop_threads(n_threads)
+    except RuntimeError:
+        # only possible before the first parallel work
+        pass
+
+
+def _run_fold(fold, folds, mean_img, data_dir, build_fn, model_save_name, batch_size, num_workers, out_size,
+              transform, train_kwargs):
+    # runs in a worker process of cross_validate, the arrays are memory-mapped
+    # from the shared npy cache instead of being sent to the process
+    np_img, np_mask, _, misc_data = load_all_data(data_dir, mmap_mode='r', check_raw=False, packed_masks=True)
+    df_depth = misc_data['df_train_all_depth']
+    train_idx = np.nonzero(folds != fold)[0]
+    val_idx = np.nonzero(folds == fold)[0]
+    datasets = {'train': SaltDataset(np_img, np_mask, df_depth, mean_img, out_size=out_size, transform=transform),
+                'val': SaltDataset(np_img, np_mask, df_depth, mean_img, out_size=out_size)}
+    dataloaders = {'train': DataLoader(datasets['train'], batch_size=batch_size, num_workers=num_workers,
+                                       sampler=torch.utils.data.SubsetRandomSampler(train_idx)),
+                   'val': DataLoader(datasets['val'], batch_size=batch_size, num_workers=num_workers,
+                                     sampler=val_idx.tolist())}
+    other_data = {'X_train': np_img, 'y_train': np_mask, 'X_val': np_img, 'y_val': np_mask,
+                  'X_train_mean_img': mean_img}
+
+    model, criterion, optimizer, scheduler = build_fn(fold)
+    fold_save_name = f'{model_save_name}-fold{fold}'
+    train_kwargs = dict({'log': get_logger(fold_save_name), 'plot_sink': PlotSink('off')}, **train_kwargs)
+    train_model(model, dataloaders, criterion, optimizer, scheduler, fold_save_name, other_data, **train_kwargs)
+
+    # no checkpoint is written if the val IOU never improved on 0
+    best_iou, checkpoint = 0., None
+    if os.path.exists(chunk_manifest_path(fold_save_name, '.')):
+        best_iou = load_model_state_from_chunks(fold_save_name, '.', keys=['stats'])['stats']['best_iou']
+        checkpoint = fold_save_name
+
+    return {'fold': fold, 'best_iou': best_iou, 'checkpoint': checkpoint,
+            'n_train': len(train_idx), 'n_val': len(val_idx)}
+
+
+def cross_validate(build_fn, data_dir='./data', n_folds=5, folds=None, by='coverage', n_bins=10, seed=0,
+                   n_jobs=None, threads_per_fold=None, model_save_name='cv', batch_size=32, num_workers=0,
+                   out_size=101, transform=None, **train_kwargs):
+    """Train one model per fold with train_model, several folds at a time.
+
+    The data is loaded once with load_all_data to build the folds and the
+    per-fold mean images; the fold processes then memory-map the same npy
+    cache, so all of them share one copy of the data in the page cache.
+
+    Args:
+        build_fn (callable): build_fn(fold) returns (model, criterion,
+            optimizer, scheduler). It is sent to spawned processes, so it
+            must be a module level function and the calling script needs an
+            if __name__ == '__main__' guard.
+        folds (ndarray, optional): Fold number of every training image,
+            defaults to make_stratified_folds(by=by, n_bins=n_bins).
+        n_jobs (int): Number of folds trained at the same time, defaults to
+            n_folds capped at the cpu count. 1 trains in this process.
+        threads_per_fold (int): torch/OpenMP threads of each fold, defaults
+            to the cpu count divided by n_jobs so the folds don't
+            oversubscribe the cores.
+        model_save_name (string): Checkpoints are saved as
+            '{model_save_name}-fold{k}' and logs to get_logger of that name.
+        train_kwargs: Passed to train_model, e.g. num_epochs.
+    Returns:
+        DataFrame: best_iou, checkpoint (the prefix for
+            load_model_state_from_chunks, None if nothing was saved),
+            n_train and n_val of every fold.
+    """
+    np_img, np_mask, _, misc_data = load_all_data(data_dir, mmap_mode='r', packed_masks=True)
+    if folds is None:
+        folds = make_stratified_folds(misc_data['df_train_all_depth'], np_mask, n_folds=n_folds, by=by,
+                                      n_bins=n_bins, seed=seed)
+    folds = np.asarray(folds)
+    n_folds = int(folds.max()) + 1
+    mean_imgs = fold_mean_images(np_img, folds, n_folds)
+    del np_img, np_mask
+
+    cpu_count = os.cpu_count() or 1
+    n_jobs = n_jobs or min(n_folds, cpu_count)
+    threads_per_fold = threads_per_fold or max(1, cpu_count // n_jobs)
+    args = [(fold, folds, mean_imgs[fold], data_dir, build_fn, model_save_name, batch_size, num_workers,
+             out_size, transform, train_kwargs) for fold in range(n_folds)]
+    if n_jobs == 1:
+        results = [_run_fold(*a) for a in args]
+    else:
+        # spawn, forking a process that already runs torch threads is unsafe
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp.get_context('spawn'),
+                                 initializer=_limit_threads, initargs=(threads_per_fold,)) as pool:
+            results = list(pool.map(_run_fold, *zip(*args)))
+
+    import pandas as pd
+    results = pd.DataFrame(results).set_index('fold')
+    print(results)
+    print('Mean best val IOU over {} folds: {:.4f}'.format(n_folds, results['best_iou'].mean()))
+
+    return results
 
 
 def push_log_to_git():
@@ -712,18 +2968,13 @@ class Dice_Loss(nn.Module):
         self.alpha = alpha
 
     def forward(self, inputs, targets):
-        def _dice_loss(a, b):
-            iflat = a.contiguous().view(1, -1)
-            tflat = b.contiguous().view(1, -1)
-            intersection = (iflat * tflat).sum()
-
-            dice_loss = 1 - ((2. * intersection + self.smooth) /
-                             (iflat.sum() + tflat.sum() + self.smooth))
+        iflat = inputs.contiguous().view(inputs.shape[0], -1)
+        tflat = targets.contiguous().view(targets.shape[0], -1)
+        intersection = (iflat * tflat).sum(1)
+        dice_loss = 1 - ((2. * intersection + self.smooth) /
+                         (iflat.sum(1) + tflat.sum(1) + self.smooth))
 
-            return dice_loss
-        dice_loss = torch.stack([_dice_loss(a, b) for a,b in zip(inputs, targets)]).mean() * self.alpha
-
-        return dice_loss
+        return dice_loss.mean() * self.alpha
 
 
 class FocalLoss(nn.Module):
@@ -766,12 +3017,49 @@ class LovaszHingeLoss(nn.Module):
           ignore: void class id
         """
         if per_image:
-            loss = self.mean(self.lovasz_hinge_flat(*self.flatten_binary_scores(log.unsqueeze(0), lab.unsqueeze(0), ignore))
-                              for log, lab in zip(logits, labels))
+            loss = self.lovasz_hinge_batch(logits.reshape(logits.shape[0], -1),
+                                           labels.reshape(labels.shape[0], -1), ignore).mean()
         else:
-            loss = self.lovasz_hinge_flat(*self.flatten_binary_scores(logits, labels, ignore))
+            loss = self.lovasz_hinge_batch(logits.reshape(1, -1), labels.reshape(1, -1), ignore)[0]
         return loss
 
+    def lovasz_hinge_batch(self, logits, labels, ignore=None):
+        """
+        Binary Lovasz hinge loss of every row, sorted and reduced in one go
+          logits: [B, P] Variable, logits at each prediction (between -\infty and +\infty)
+          labels: [B, P] Tensor, binary ground truth labels (0 or 1)
+          ignore: label to ignore
+        Returns a [B] tensor, same as lovasz_hinge_flat on each row.
+        """
+        signs = 2. * labels.float() - 1.
+        errors = (1. - logits * signs)
+        if ignore is None:
+            valid = torch.ones_like(errors, dtype=torch.bool)
+        else:
+            # ignored pixels are sorted to the end and masked out
+            valid = (labels != ignore)
+            errors = errors.masked_fill(~valid, -float('inf'))
+        errors_sorted, perm = torch.sort(errors, dim=1, descending=True)
+        perm = perm.data
+        valid_sorted = valid.gather(1, perm)
+        gt_sorted = labels.gather(1, perm).float() * valid_sorted
+        grad = self.lovasz_grad_batch(gt_sorted, valid_sorted.float())
+        loss = (F.relu(errors_sorted) * grad).sum(1)
+        return loss
+
+    def lovasz_grad_batch(self, gt_sorted, valid_sorted):
+        """
+        lovasz_grad of every row of gt_sorted, rows padded with invalid pixels
+        at the end
+        """
+        gts = gt_sorted.sum(1, keepdim=True)
+        intersection = gts - gt_sorted.cumsum(1)
+        union = gts + ((1 - gt_sorted) * valid_sorted).cumsum(1)
+        # union is only 0 for rows without valid pixels, where grad is masked
+        jaccard = 1. - intersection / union.clamp(min=1)
+        jaccard = torch.cat([jaccard[:, :1], jaccard[:, 1:] - jaccard[:, :-1]], 1)
+        return jaccard * valid_sorted
+
     def lovasz_hinge_flat(self, logits, labels):
         """
         Binary Lovasz hinge loss
@@ -847,22 +3135,76 @@ class HingeLoss(nn.Module):
         super(HingeLoss, self).__init__()
 
     def forward(self, inputs, targets):
-        pos_y = torch.masked_select(inputs, targets.ge(0.5))
-        neg_y = torch.masked_select(inputs, targets.lt(0.5))
-
-        if pos_y.numel() > 0:
-            pos_loss = F.relu(1-pos_y).mean()
-        else:
-            pos_loss = 0.
-
-        if neg_y.numel() > 0:
-            pos_loss = F.relu(neg_y + 1).mean()
-        else:
-            neg_loss = 0.
+        pos = targets.ge(0.5).float()
+        neg = 1 - pos
+        # masked means, 0 when there are no positive or no negative pixels
+        pos_loss = (F.relu(1 - inputs) * pos).sum() / pos.sum().clamp(min=1)
+        neg_loss = (F.relu(inputs + 1) * neg).sum() / neg.sum().clamp(min=1)
 
         loss = pos_loss + neg_loss
         return loss
 
 
+class CombinedLoss(nn.Module):
+    """Weighted sum of IOU_Loss, Dice_Loss, FocalLoss, LovaszHingeLoss and
+    HingeLoss computed in one pass.
+
+    The per-image intersection and sums and the BCE term are computed once on
+    (B, H*W) views and shared by the components. Components with weight 0
+    are skipped. The unweighted value of each component from the last call
+    is kept in self.components for logging.
+
+    Args:
+        iou, dice, focal, lovasz, hinge (float): Component weights.
+        smooth (float): Dice_Loss smooth.
+        focal_alpha, focal_gamma (float): FocalLoss alpha and gamma.
+        logits (bool): FocalLoss logits.
+    """
+
+    def __init__(self, iou=0, dice=0, focal=0, lovasz=0, hinge=0, smooth=1,
+                 focal_alpha=1, focal_gamma=2, logits=False):
+        super(CombinedLoss, self).__init__()
+        self.weights = {'iou': iou, 'dice': dice, 'focal': focal, 'lovasz': lovasz, 'hinge': hinge}
+        self.smooth = smooth
+        self.focal_alpha = focal_alpha
+        self.focal_gamma = focal_gamma
+        self.logits = logits
+        self.lovasz_loss = LovaszHingeLoss()
+        self.components = {}
+
+    def forward(self, inputs, targets):
+        p = inputs.contiguous().view(inputs.shape[0], -1)
+        y = targets.contiguous().view(targets.shape[0], -1).to(p.dtype)
+        w = self.weights
+        losses = {}
+
+        if w['iou'] or w['dice']:
+            i = (p * y).sum(1)
+            p_sum_y = p.sum(1) + y.sum(1)
+            if w['iou']:
+                losses['iou'] = 1 - (i / (p_sum_y - i)).mean()
+            if w['dice']:
+                losses['dice'] = (1 - (2. * i + self.smooth) / (p_sum_y + self.smooth)).mean()
+        if w['focal']:
+            if self.logits:
+                bce = F.binary_cross_entropy_with_logits(p, y, reduction='none')
+            else:
+                bce = F.binary_cross_entropy(p, y, reduction='none')
+            losses['focal'] = (self.focal_alpha * (1 - torch.exp(-bce))**self.focal_gamma * bce).mean()
+        if w['lovasz']:
+            losses['lovasz'] = self.lovasz_loss.lovasz_hinge_batch(p, y).mean()
+        if w['hinge']:
+            pos = y.ge(0.5).to(p.dtype)
+            neg = 1 - pos
+            losses['hinge'] = ((F.relu(1 - p) * pos).sum() / pos.sum().clamp(min=1) +
+                               (F.relu(p + 1) * neg).sum() / neg.sum().clamp(min=1))
+
+        loss = sum(w[k] * v for k, v in losses.items())
+        self.components = {k: v.detach() for k, v in losses.items()}
+
+        return loss
 
 
+# `from salt_func_lib import *` goes through __getattr__ for the names in
+# __all__, so star imports still get pd, plt, transforms etc. as before
+__all__ = [name for name in globals() if not name.startswith('_')] + list(_LAZY_MODULES) + list(_LAZY_NAMES)